@@ -0,0 +1,66 @@
+import tensorflow as tf
+
+from metrics import class_indices
+
+class ConfusionMatrixMetric(tf.keras.metrics.Metric):
+    """Confusion matrix accumulated over the whole epoch (rows: GT, cols: pred).
+
+    Every logged score is derived from the accumulated matrix in result(), so
+    there is no per-batch averaging and the output is only reduced once per step.
+    """
+    def __init__(self, num_classes=6, name="confusion_matrix", **kwargs):
+        super().__init__(name=name, **kwargs)
+        self.num_classes = num_classes
+        # float64 keeps pixel counts exact well past 2^24 pixels per epoch
+        self.cm = self.add_weight(
+            name="cm", shape=(num_classes, num_classes), initializer="zeros", dtype=tf.float64
+        )
+
+    def update_state(self, y_true, y_pred, sample_weight=None):
+        # Sparse labels are used as they are, one-hot labels are reduced with argmax
+        y_true_labels = tf.reshape(class_indices(y_true, self.num_classes), [-1])
+        y_pred_labels = tf.reshape(tf.argmax(y_pred, axis=-1, output_type=tf.int32), [-1])
+
+        weights = None
+        if sample_weight is not None:
+            # Per-sample weights are spread over the pixels of that sample
+            sample_weight = tf.cast(sample_weight, tf.float64)
+            weights = tf.reshape(tf.broadcast_to(
+                tf.reshape(sample_weight, [-1] + [1] * (len(y_pred.shape) - 2)), tf.shape(y_pred)[:-1]
+            ), [-1])
+
+        cm = tf.math.confusion_matrix(
+            y_true_labels, y_pred_labels, num_classes=self.num_classes, weights=weights, dtype=tf.float64
+        )
+        self.cm.assign_add(cm)
+
+    def result(self):
+        tp = tf.linalg.diag_part(self.cm)
+        gt = tf.reduce_sum(self.cm, axis=1)
+        pred = tf.reduce_sum(self.cm, axis=0)
+
+        dice = tf.math.divide_no_nan(2.0 * tp, gt + pred)
+        iou = tf.math.divide_no_nan(tp, gt + pred - tp)
+        precision = tf.math.divide_no_nan(tp, pred)
+        recall = tf.math.divide_no_nan(tp, gt)
+
+        results = {
+            # mean of foreground classes, as dice_coef_multi reported it
+            "dice": tf.reduce_mean(dice[1:]),
+            "iou": tf.reduce_mean(iou[1:]),
+            "pixel_accuracy": tf.math.divide_no_nan(tf.reduce_sum(tp), tf.reduce_sum(self.cm)),
+        }
+        for c in range(self.num_classes):
+            results[f"dice_class_{c}"] = dice[c]
+            results[f"iou_class_{c}"] = iou[c]
+            results[f"precision_class_{c}"] = precision[c]
+            results[f"recall_class_{c}"] = recall[c]
+        return {key: tf.cast(value, tf.float32) for key, value in results.items()}
+
+    def reset_state(self):
+        self.cm.assign(tf.zeros_like(self.cm))
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({"num_classes": self.num_classes})
+        return config
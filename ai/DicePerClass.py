@@ -1,5 +1,7 @@
 import tensorflow as tf
 
+from metrics import one_hot_labels
+
 class DicePerClassMetric(tf.keras.metrics.Metric):
     def __init__(self, class_idx, name=None, **kwargs):
         super().__init__(name=name or f"dice_class_{class_idx}", **kwargs)
@@ -8,6 +10,7 @@ class DicePerClassMetric(tf.keras.metrics.Metric):
         self.count = self.add_weight(name="count", initializer="zeros")
     
     def update_state(self, y_true, y_pred, sample_weight=None):
+        y_true = one_hot_labels(y_true, dtype=y_pred.dtype)
         y_true_f = tf.reshape(y_true[..., self.class_idx], [-1])
         y_pred_f = tf.reshape(y_pred[..., self.class_idx], [-1])
         intersection = tf.reduce_sum(y_true_f * y_pred_f)
@@ -0,0 +1,98 @@
+import tensorflow as tf
+
+class GradientAccumulationModel(tf.keras.Model):
+    """Functional model whose train_step sums gradients over accum_steps micro-batches
+    and applies them once, for a larger effective batch at the same activation memory.
+
+    Metrics and the loss are still updated on every micro-batch, so the epoch logs
+    (and every callback reading them) look the same as without accumulation.
+    """
+    def __init__(self, *args, accum_steps=1, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.accum_steps = accum_steps
+        self.accum_step = tf.Variable(0, dtype=tf.int64, trainable=False, name="accum_step")
+        # One buffer per initially trainable variable, looked up by variable so layers can
+        # be frozen/unfrozen later (e.g. the pretrained encoder) without rebuilding them
+        self.accum_grads = [
+            tf.Variable(tf.zeros_like(v), trainable=False, name=f"accum_{i}")
+            for i, v in enumerate(self.trainable_variables)
+        ]
+        # id() rather than Variable.ref(), which Keras 3 variables do not have
+        self._accum_ids = [id(v) for v in self.trainable_variables]
+        self._compile_args = None
+        self._plain_model = None
+
+    def compile(self, *args, **kwargs):
+        self._compile_args = (args, kwargs)
+        super().compile(*args, **kwargs)
+        # Slot variables must exist before the first (conditional) update, and outside the
+        # traced train step (Keras 3's LossScaleOptimizer would create them on every trace)
+        self.optimizer.build(self.trainable_variables)
+
+    def _accumulators(self, variables):
+        index = dict(zip(self._accum_ids, self.accum_grads))
+        return [index[id(v)] for v in variables]
+
+    def _apply_accumulated(self):
+        # Mean over the micro-batches summed so far (fewer than accum_steps when flushed)
+        count = tf.cast(self.accum_step, self.accum_grads[0].dtype)
+        grads = [g / count for g in self._accumulators(self.trainable_variables)]
+        self.optimizer.apply_gradients(zip(grads, self.trainable_variables))
+        for g in self.accum_grads:
+            g.assign(tf.zeros_like(g))
+        self.accum_step.assign(0)
+
+    def flush_accumulated(self):
+        """Apply a partial accumulation now, so it is neither lost at the end of training
+        nor mixed into the first update of the next epoch"""
+        if int(self.accum_step.numpy()) > 0:
+            self._apply_accumulated()
+
+    def train_step(self, data):
+        x, y, sample_weight = tf.keras.utils.unpack_x_y_sample_weight(data)
+        # Keras 3 optimizers scale the loss themselves and unscale in apply_gradients; Keras 2's
+        # LossScaleOptimizer leaves both to the train step
+        keras3_scaling = hasattr(self.optimizer, "scale_loss")
+        legacy_scaling = not keras3_scaling and isinstance(self.optimizer, tf.keras.mixed_precision.LossScaleOptimizer)
+
+        with tf.GradientTape() as tape:
+            y_pred = self(x, training=True)
+            loss = self.compute_loss(x, y, y_pred, sample_weight)
+            if keras3_scaling:
+                # The scale only changes when an update is applied, so the sum stays consistent
+                scaled_loss = self.optimizer.scale_loss(loss)
+            elif legacy_scaling:
+                scaled_loss = self.optimizer.get_scaled_loss(loss)
+            else:
+                scaled_loss = loss
+        grads = tape.gradient(scaled_loss, self.trainable_variables)
+        if legacy_scaling:
+            # Accumulate unscaled gradients; a non-finite sum makes the optimizer skip the update
+            grads = self.optimizer.get_unscaled_gradients(grads)
+
+        for accum, g in zip(self._accumulators(self.trainable_variables), grads):
+            if g is not None:
+                accum.assign_add(tf.convert_to_tensor(g))
+        self.accum_step.assign_add(1)
+
+        tf.cond(self.accum_step >= self.accum_steps, self._apply_accumulated, lambda: None)
+        return self.compute_metrics(x, y, y_pred, sample_weight)
+
+    def save(self, filepath, *args, **kwargs):
+        """Save as a plain functional model, so the file loads without this class"""
+        if self._plain_model is None:
+            self._plain_model = tf.keras.Model(self.inputs, self.outputs, name=self.name)
+            if self._compile_args is not None:
+                args_, kwargs_ = self._compile_args
+                self._plain_model.compile(*args_, **kwargs_)
+        self._plain_model.save(filepath, *args, **kwargs)
+
+class FlushAccumulatedGradients(tf.keras.callbacks.Callback):
+    """Calls flush_accumulated after the last training batch of every epoch, before validation
+    (at epoch end when the number of steps is unknown). Must come before ModelCheckpoint."""
+    def on_train_batch_end(self, batch, logs=None):
+        if batch + 1 == self.params.get("steps"):
+            self.model.flush_accumulated()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.model.flush_accumulated()
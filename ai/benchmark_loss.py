@@ -0,0 +1,99 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import numpy as np
+import tensorflow as tf
+
+from metrics import NUM_CLASSES, combined_loss, combined_loss_reference
+from memory_usage import memory_kind, reset_peak_memory, current_memory_mb, peak_memory_mb
+
+# ---------------- PARAMETERS ----------------
+LOSSES = {
+    "reference": combined_loss_reference,
+    "fused": combined_loss,
+}
+
+def make_inputs(batch, height, width):
+    """Same random logits and uint8 labels in every process"""
+    rng = np.random.default_rng(0)
+    logits = tf.Variable(rng.normal(size=(batch, height, width, NUM_CLASSES)).astype(np.float32))
+    labels = tf.constant(rng.integers(0, NUM_CLASSES, (batch, height, width, 1)), dtype=tf.uint8)
+    return logits, labels
+
+def loss_step(loss_fn, logits, labels):
+    @tf.function
+    def step():
+        with tf.GradientTape() as tape:
+            loss = loss_fn(labels, tf.nn.softmax(logits))
+        return loss, tape.gradient(loss, logits)
+    return step
+
+def run_variant(name, batch, height, width, steps, warmup):
+    """Time forward + backward of one loss; run in its own process so peak RSS is not shared"""
+    logits, labels = make_inputs(batch, height, width)
+    step = loss_step(LOSSES[name], logits, labels)
+
+    # Warmup traces and compiles, the measured window only covers the steady-state steps
+    for _ in range(warmup):
+        step()[0].numpy()
+    baseline = current_memory_mb()
+    reset_peak_memory()
+
+    times = []
+    for _ in range(steps):
+        start = time.perf_counter()
+        loss, _ = step()
+        loss.numpy()
+        times.append(time.perf_counter() - start)
+
+    return {
+        "variant": name,
+        "step_ms": 1000 * float(np.mean(times)),
+        "p50_ms": 1000 * float(np.median(times)),
+        "peak_mb": peak_memory_mb() - baseline,
+        "memory": f"{memory_kind()} peak above baseline",
+    }
+
+def check_equivalence(batch, height, width):
+    """Max absolute difference of loss and gradient between the fused and reference loss"""
+    logits, labels = make_inputs(batch, height, width)
+    loss_ref, grad_ref = loss_step(combined_loss_reference, logits, labels)()
+    loss_fused, grad_fused = loss_step(combined_loss, logits, labels)()
+    return float(tf.abs(loss_ref - loss_fused)), float(tf.reduce_max(tf.abs(grad_ref - grad_fused)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Step time and peak memory of combined_loss, fused vs reference")
+    parser.add_argument("--batch-size", type=int, default=2)
+    parser.add_argument("--height", type=int, default=256)
+    parser.add_argument("--width", type=int, default=256)
+    parser.add_argument("--steps", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--variant", choices=list(LOSSES), help="run a single variant and print JSON (internal)")
+    args = parser.parse_args()
+
+    if args.variant:
+        print(json.dumps(run_variant(args.variant, args.batch_size, args.height, args.width, args.steps, args.warmup)))
+        sys.exit(0)
+
+    results = []
+    for name in LOSSES:
+        out = subprocess.run(
+            [sys.executable, __file__, "--variant", name, "--batch-size", str(args.batch_size),
+             "--height", str(args.height), "--width", str(args.width),
+             "--steps", str(args.steps), "--warmup", str(args.warmup)],
+            check=True, capture_output=True, text=True,
+            # Lets the CPU allocator report peak memory, see memory_usage.py
+            env={**os.environ, "TF_CPU_ALLOCATOR_USE_BFC": "true"},
+        )
+        results.append(json.loads(out.stdout.strip().splitlines()[-1]))
+
+    loss_diff, grad_diff = check_equivalence(args.batch_size, args.height, args.width)
+
+    print(f"Batch {args.batch_size} x {args.height}x{args.width}x{NUM_CLASSES}, {args.steps} steps")
+    for r in results:
+        print(f"{r['variant']:>10}: {r['step_ms']:.2f} ms/step (p50 {r['p50_ms']:.2f} ms), "
+              f"{r['memory']}: {r['peak_mb']:.1f} MB")
+    print(f"Max abs difference: loss {loss_diff:.2e}, gradient {grad_diff:.2e}")
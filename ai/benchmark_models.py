@@ -0,0 +1,142 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+# ---------------- PARAMETERS ----------------
+H = 256
+W = 256
+BACKEND_OF_EXTENSION = {".h5": "keras", ".onnx": "onnx", ".tflite": "tflite"}
+
+def backend_of(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in BACKEND_OF_EXTENSION:
+        raise ValueError(f"Unknown model file {path}, expected one of {list(BACKEND_OF_EXTENSION)}")
+    return BACKEND_OF_EXTENSION[ext]
+
+def powers_of_two(limit):
+    """1, 2, 4, ... up to and including limit"""
+    values = [1]
+    while values[-1] * 2 < limit:
+        values.append(values[-1] * 2)
+    return sorted(set(values + [limit]))
+
+def set_threads(threads):
+    """Limit TensorFlow to `threads` CPU threads. It reads these settings once, before the
+    first op runs, which is why every thread count runs in a fresh process."""
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+def run_config(path, threads, batch_sizes, runs, warmup):
+    """Cold load, then warm latency per batch size on synthetic uint8 frames (own process)"""
+    backend = backend_of(path)
+    set_threads(threads)  # before the imports below, they already run TF ops
+    from memory_usage import memory_kind, reset_peak_memory, peak_memory_mb
+    # Imported before the clock starts: TF, cv2 and the model code are process startup, not model loading
+    from inference_backends import load_predictor
+
+    start = time.perf_counter()
+    predictor = load_predictor(backend, path, threads)
+    load_s = time.perf_counter() - start
+
+    # The exported input size (ONNX with --input-size), so no host-side resize is timed
+    height, width = getattr(predictor, "size", (H, W))
+    rng = np.random.default_rng(0)
+
+    rows = []
+    for batch in batch_sizes:
+        images = rng.integers(0, 256, (batch, height, width, 3), dtype=np.uint8)
+        reset_peak_memory()
+        start = time.perf_counter()
+        predictor.predict_classes(images)
+        first_ms = 1000 * (time.perf_counter() - start)
+        for _ in range(warmup):
+            predictor.predict_classes(images)
+
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            predictor.predict_classes(images)
+            times.append(time.perf_counter() - start)
+        times_ms = 1000 * np.array(times)
+
+        rows.append({
+            "model": os.path.basename(path),
+            "backend": backend,
+            "threads": threads,
+            "batch": batch,
+            "load_s": load_s,
+            "first_inference_ms": first_ms,
+            "p50_ms": float(np.percentile(times_ms, 50)),
+            "p95_ms": float(np.percentile(times_ms, 95)),
+            "p99_ms": float(np.percentile(times_ms, 99)),
+            "mean_ms": float(times_ms.mean()),
+            "images_per_sec": batch / float(np.mean(times)),
+            "peak_memory_mb": peak_memory_mb(),
+            "memory": memory_kind(),
+        })
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inference latency/throughput of .h5, .tflite and .onnx models")
+    parser.add_argument("models", nargs="*", help="model files, backend chosen by extension")
+    parser.add_argument("--max-batch", type=int, default=8, help="batch sizes 1, 2, 4, ... up to this")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=None, help="explicit batch sizes")
+    parser.add_argument("--max-threads", type=int, default=os.cpu_count(), help="threads 1, 2, 4, ... up to this")
+    parser.add_argument("--threads", type=int, nargs="+", default=None, help="explicit thread counts")
+    parser.add_argument("--runs", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--output-dir", default=None, help="default: folder of the first model (results/<name>/)")
+    parser.add_argument("--config", nargs=2, metavar=("MODEL", "THREADS"), help="run a single configuration and print JSON (internal)")
+    args = parser.parse_args()
+
+    batch_sizes = args.batch_sizes or powers_of_two(args.max_batch)
+
+    if args.config:
+        path, threads = args.config
+        print(json.dumps(run_config(path, int(threads), batch_sizes, args.runs, args.warmup)))
+        sys.exit(0)
+
+    if not args.models:
+        parser.error("at least one model file is required")
+    thread_counts = args.threads or powers_of_two(args.max_threads)
+    rows = []
+    for path in args.models:
+        for threads in thread_counts:
+            print(f"Benchmarking {path} ({backend_of(path)}), {threads} thread(s), batch {batch_sizes}...")
+            out = subprocess.run(
+                [sys.executable, __file__, "--config", path, str(threads),
+                 "--batch-sizes", *map(str, batch_sizes), "--runs", str(args.runs), "--warmup", str(args.warmup)],
+                check=True, capture_output=True, text=True,
+                env={**os.environ, "TF_CPP_MIN_LOG_LEVEL": "3"},
+            )
+            rows.extend(json.loads(out.stdout.strip().splitlines()[-1]))
+
+    # ---------------- REPORT ----------------
+    df = pd.DataFrame(rows)
+    print(f"\n--- Inference benchmark ({platform.processor() or platform.machine()}, {os.cpu_count()} CPUs, "
+          f"{args.runs} runs) ---")
+    print(df[["model", "threads", "batch", "load_s", "p50_ms", "p95_ms", "p99_ms", "images_per_sec"]]
+          .to_string(index=False, float_format=lambda v: f"{v:.2f}"))
+
+    output_dir = args.output_dir or os.path.dirname(os.path.abspath(args.models[0]))
+    os.makedirs(output_dir, exist_ok=True)
+    report = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "host": {"machine": platform.machine(), "processor": platform.processor(), "cpus": os.cpu_count(),
+                 "python": platform.python_version()},
+        "runs": args.runs,
+        "warmup": args.warmup,
+        "results": rows,
+    }
+    with open(os.path.join(output_dir, "benchmark.json"), "w") as f:
+        json.dump(report, f, indent=2)
+    df.to_csv(os.path.join(output_dir, "benchmark.csv"), index=False)
+    print(f"Saved {os.path.join(output_dir, 'benchmark.json')} and benchmark.csv")
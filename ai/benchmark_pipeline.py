@@ -0,0 +1,241 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+import pandas as pd
+import cv2
+import yaml
+
+# ---------------- PARAMETERS ----------------
+DATASET_PATH = "./post_dataset_taco"
+STAGES = ["decode", "mask_conversion", "augmentation", "batching"]
+
+def read_config(file_path):
+    if file_path is None:
+        return {"name": "default"}
+    with open(file_path, 'r') as file:
+        return yaml.safe_load(file)
+
+# ---------------- SYNTHETIC DATASET ----------------
+def make_synthetic_dataset(path, num_samples, height, width, color_masks=False, seed=0):
+    """images/ and masks/ PNGs shaped like post_dataset_taco: smooth backgrounds with a few
+    objects, masks as class indices (or legacy BGR colors with color_masks)"""
+    from train import CLASS_COLORS
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.join(path, "images"), exist_ok=True)
+    os.makedirs(os.path.join(path, "masks"), exist_ok=True)
+
+    yy, xx = np.mgrid[0:height, 0:width].astype(np.float32)
+    for i in range(num_samples):
+        image = np.zeros((height, width, 3), dtype=np.float32)
+        for c in range(3):
+            image[:, :, c] = rng.uniform(40, 200) + rng.uniform(-40, 40) * (xx / width) + rng.uniform(-40, 40) * (yy / height)
+        mask = np.zeros((height, width), dtype=np.uint8)
+        for _ in range(rng.integers(1, 5)):
+            cls = int(rng.integers(1, len(CLASS_COLORS)))
+            center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+            axes = (int(rng.integers(width // 20, width // 5)), int(rng.integers(height // 20, height // 5)))
+            angle = float(rng.uniform(0, 180))
+            cv2.ellipse(image, center, axes, angle, 0, 360, rng.uniform(0, 255, 3).tolist(), -1)
+            cv2.ellipse(mask, center, axes, angle, 0, 360, cls, -1)
+        image += rng.normal(0, 4, image.shape)
+
+        name = f"synthetic_{i:05d}.png"
+        cv2.imwrite(os.path.join(path, "images", name), np.clip(image, 0, 255).astype(np.uint8))
+        stored = np.array(CLASS_COLORS, dtype=np.uint8)[mask] if color_masks else mask
+        cv2.imwrite(os.path.join(path, "masks", name), stored)
+    print(f"Synthetic dataset: {num_samples} samples of {height}x{width} in {path}")
+
+# ---------------- STAGES ----------------
+def _timed(fn, *args):
+    start = time.perf_counter()
+    out = fn(*args)
+    return out, time.perf_counter() - start
+
+def stage_times(X, Y, batch_size, use_augmentation):
+    """Serial per-sample time of every stage tf_dataset runs for these samples (seconds).
+    Same steps as tf_parse / tf_parse_graph, split so each one can be timed on its own."""
+    import tensorflow as tf
+    import train
+    import image_proccessing
+    from train import W, H, read_image, read_packed, color_to_class_mask
+
+    totals = dict.fromkeys(STAGES, 0.0)
+    samples = []
+    if image_proccessing.AUGMENTATION_BACKEND == "tensorflow":
+        decode_image = tf.function(train.tf_read_image)
+        decode_mask = tf.function(lambda path: tf.image.resize(
+            tf.io.decode_png(tf.io.read_file(path), channels=0), (H, W), method="nearest"))
+        convert_mask = tf.function(lambda mask: tf.cond(
+            tf.shape(mask)[-1] == 1, lambda: mask[:, :, :1], lambda: train.tf_color_to_class_mask(mask)))
+        augment = tf.function(image_proccessing.apply_tf_transform)
+        # The first sample only traces the tf.functions and is not counted
+        for i, (x, y) in enumerate([(X[0], Y[0])] + list(zip(X, Y))):
+            if i == 1:
+                totals = dict.fromkeys(STAGES, 0.0)
+                samples = []
+            if train.PACKED is not None:
+                (image, mask), t = _timed(read_packed, x)
+            else:
+                image, t1 = _timed(lambda p: decode_image(tf.constant(p)).numpy(), x)
+                mask, t2 = _timed(lambda p: decode_mask(tf.constant(p)).numpy(), y)
+                t = t1 + t2
+                mask, t_convert = _timed(lambda m: convert_mask(m).numpy(), mask)
+                totals["mask_conversion"] += t_convert
+            totals["decode"] += t
+            if use_augmentation:
+                (image, mask), t = _timed(lambda i, m: [v.numpy() for v in augment(i, m)], image, mask)
+                totals["augmentation"] += t
+            samples.append((image, mask.astype(np.uint8)))
+    else:
+        for x, y in zip(X, Y):
+            if train.PACKED is not None:
+                (image, mask), t = _timed(read_packed, x)
+            else:
+                image, t1 = _timed(read_image, x)
+                # read_mask, with the color -> class conversion of legacy masks timed apart
+                mask, t2 = _timed(lambda p: cv2.resize(cv2.imread(p, cv2.IMREAD_UNCHANGED), (W, H),
+                                                       interpolation=cv2.INTER_NEAREST), y)
+                t = t1 + t2
+                if mask.ndim == 3:
+                    mask, t_convert = _timed(color_to_class_mask, mask[:, :, :3])
+                    totals["mask_conversion"] += t_convert
+                mask = mask[:, :, np.newaxis]
+            totals["decode"] += t
+            if use_augmentation:
+                transformed, t = _timed(image_proccessing.apply_transform, image, mask)
+                image, mask = transformed["image"], transformed["mask"]
+                totals["augmentation"] += t
+            samples.append((image, np.ascontiguousarray(mask[:, :, :1], dtype=np.uint8)))
+
+    # Batching: collating ready samples into batches, as dataset.batch() does after the map
+    images = np.stack([s[0] for s in samples])
+    masks = np.stack([s[1] for s in samples])
+    dataset = tf.data.Dataset.from_tensor_slices((images, masks)).batch(batch_size)
+    for _ in dataset:  # warmup
+        pass
+    start = time.perf_counter()
+    for _ in dataset:
+        pass
+    totals["batching"] = time.perf_counter() - start
+    return {stage: total / len(X) for stage, total in totals.items()}
+
+def pipeline_throughput(X, Y, batch_size, use_augmentation, num_batches):
+    """Samples/sec of the real tf_dataset (parallel map, prefetch) without a model"""
+    from train import tf_dataset
+    dataset = tf_dataset(X, Y, batch=batch_size, use_augmentation=use_augmentation).repeat()
+    iterator = iter(dataset)
+    next(iterator)  # warmup: tracing, thread pools, shuffle buffer
+    start = time.perf_counter()
+    samples = 0
+    for _ in range(num_batches):
+        images, _ = next(iterator)
+        samples += int(images.shape[0])
+    elapsed = time.perf_counter() - start
+    return samples / elapsed, 1000 * elapsed / num_batches
+
+def run_config(config_path, use_augmentation, dataset_path, batch_size, num_batches, stage_samples):
+    """One pipeline configuration, in its own process: the augmentation backend and the packed
+    dataset are module-level state in image_proccessing and train"""
+    import train
+    from image_proccessing import init_transform
+    import image_proccessing
+
+    config_params = read_config(config_path)
+    init_transform(config_params)
+    batch_size = batch_size or int(config_params.get("batch_size", 2))
+    packed = bool(config_params.get("packed", False))
+    if packed:
+        (train_x, train_y), _, _ = train.load_packed_dataset(os.path.join(dataset_path, train.PACKED_DIR))
+    else:
+        (train_x, train_y), _, _ = train.load_dataset(dataset_path)
+
+    stages = stage_times(train_x[:stage_samples], train_y[:stage_samples], batch_size, use_augmentation)
+    samples_per_sec, batch_ms = pipeline_throughput(train_x, train_y, batch_size, use_augmentation, num_batches)
+    serial_ms = 1000 * sum(stages.values())
+    return {
+        "config": config_params.get("name", "default"),
+        "augmentation": use_augmentation,
+        "backend": image_proccessing.AUGMENTATION_BACKEND,
+        "packed": packed,
+        "batch": batch_size,
+        **{f"{stage}_ms": 1000 * value for stage, value in stages.items()},
+        "serial_ms_per_sample": serial_ms,
+        "bottleneck": max(stages, key=stages.get),
+        "samples_per_sec": samples_per_sec,
+        "ms_per_batch": batch_ms,
+        # > 1: the parallel map/prefetch hides part of the serial cost
+        "parallel_speedup": samples_per_sec * serial_ms / 1000,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Throughput of the train.py input pipeline without the model")
+    parser.add_argument("configs", nargs="*", help="training configs to compare (augmentation, packed, batch_size); "
+                                                   "default: no augmentation, PNG dataset")
+    parser.add_argument("--dataset", default=DATASET_PATH)
+    parser.add_argument("--synthetic", type=int, default=0, metavar="N",
+                        help="benchmark on N generated samples instead of --dataset (works without TACO)")
+    parser.add_argument("--synthetic-size", type=int, nargs=2, default=[480, 640], metavar=("HEIGHT", "WIDTH"))
+    parser.add_argument("--color-masks", action="store_true", help="synthetic masks as legacy BGR colors")
+    parser.add_argument("--keep", action="store_true", help="keep the synthetic dataset instead of deleting it")
+    parser.add_argument("--batch-size", type=int, default=None, help="default: batch_size of each config")
+    parser.add_argument("--batches", type=int, default=50, help="batches timed through tf_dataset")
+    parser.add_argument("--stage-samples", type=int, default=50, help="samples for the per-stage timing")
+    parser.add_argument("--augmentation", choices=["both", "on", "off"], default="both")
+    parser.add_argument("--output", default=os.path.join("results", "pipeline_benchmark"),
+                        help="report path without extension (.json and .csv are written)")
+    parser.add_argument("--run", nargs=2, metavar=("CONFIG", "AUGMENTATION"), help="run one configuration (internal)")
+    args = parser.parse_args()
+
+    if args.run:
+        config_path = None if args.run[0] == "-" else args.run[0]
+        result = run_config(config_path, args.run[1] == "1", args.dataset, args.batch_size, args.batches, args.stage_samples)
+        print(json.dumps(result))
+        sys.exit(0)
+
+    configs = args.configs or [None]
+    dataset_path = args.dataset
+    if args.synthetic:
+        dataset_path = tempfile.mkdtemp(prefix="synthetic_taco_")
+
+    augmentation = {"both": [False, True], "on": [True], "off": [False]}[args.augmentation]
+    rows = []
+    try:
+        if args.synthetic:
+            make_synthetic_dataset(dataset_path, args.synthetic, *args.synthetic_size, color_masks=args.color_masks)
+            if any(read_config(c).get("packed", False) for c in configs):
+                from pack_dataset import pack_dataset
+                pack_dataset(dataset_path)
+
+        for config_path in configs:
+            for use_augmentation in augmentation:
+                print(f"Benchmarking {config_path or 'default'} (augmentation {'on' if use_augmentation else 'off'})...")
+                command = [sys.executable, __file__, "--run", config_path or "-", "1" if use_augmentation else "0",
+                           "--dataset", dataset_path, "--batches", str(args.batches), "--stage-samples", str(args.stage_samples)]
+                if args.batch_size:
+                    command += ["--batch-size", str(args.batch_size)]
+                out = subprocess.run(command, check=True, capture_output=True, text=True,
+                                     env={**os.environ, "TF_CPP_MIN_LOG_LEVEL": "3"})
+                rows.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    finally:
+        if args.synthetic:
+            if args.keep:
+                print(f"Synthetic dataset kept in {dataset_path}")
+            else:
+                shutil.rmtree(dataset_path, ignore_errors=True)
+
+    # ---------------- REPORT ----------------
+    df = pd.DataFrame(rows)
+    print(f"\n--- Input pipeline ({'synthetic' if args.synthetic else dataset_path}), ms per sample unless noted ---")
+    print(df.set_index(["config", "augmentation"]).T.to_string(float_format=lambda v: f"{v:.2f}"))
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    df.to_csv(args.output + ".csv", index=False)
+    with open(args.output + ".json", "w") as f:
+        json.dump(rows, f, indent=2)
+    print(f"Saved {args.output}.json and {args.output}.csv")
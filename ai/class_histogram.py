@@ -0,0 +1,108 @@
+import os
+import argparse
+import numpy as np
+import cv2
+from glob import glob
+from tqdm import tqdm
+
+# ---------------- PARAMETERS ----------------
+NUM_CLASSES = 6  # background + 5 recycling classes
+HISTOGRAM_FILE = "class_histogram.npz"
+WEIGHT_METHODS = ["inverse_frequency", "effective_number"]
+
+# ---------------- INDEX FILE ----------------
+def mask_histogram(mask):
+    """Pixel count of every class in a class-index mask"""
+    return np.bincount(mask.ravel(), minlength=NUM_CLASSES)[:NUM_CLASSES].astype(np.int64)
+
+def load_class_histogram(dataset_path):
+    """Return (names, counts[N, NUM_CLASSES], mtimes) of the index, empty if it does not exist"""
+    path = os.path.join(dataset_path, HISTOGRAM_FILE)
+    if not os.path.exists(path):
+        return np.array([], dtype=str), np.zeros((0, NUM_CLASSES), dtype=np.int64), np.zeros(0)
+    with np.load(path) as data:
+        return data["names"], data["counts"], data["mtimes"]
+
+def save_class_histogram(dataset_path, names, counts, mtimes):
+    order = np.argsort(names)
+    path = os.path.join(dataset_path, HISTOGRAM_FILE)
+    tmp_path = path + ".tmp.npz"
+    np.savez(tmp_path, names=np.asarray(names)[order], counts=np.asarray(counts)[order],
+             mtimes=np.asarray(mtimes)[order])
+    os.replace(tmp_path, path)
+
+def record_class_histograms(dataset_path, entries):
+    """Merge {name: counts} computed while writing masks (e.g. by preprocess_taco.py) into the index"""
+    names, counts, mtimes = load_class_histogram(dataset_path)
+    index = {name: (row, mtime) for name, row, mtime in zip(names, counts, mtimes)}
+    for name, row in entries.items():
+        mask_path = os.path.join(dataset_path, "masks", name + ".png")
+        index[name] = (row, os.path.getmtime(mask_path))
+    names = list(index)
+    save_class_histogram(dataset_path, names, [index[n][0] for n in names], [index[n][1] for n in names])
+
+def update_class_histogram(dataset_path, read_mask=None):
+    """Bring the index in sync with masks/, only reading new or modified masks.
+
+    read_mask(path) must return class indices; by default masks are read as
+    single-channel index PNGs.
+    """
+    if read_mask is None:
+        read_mask = lambda path: cv2.imread(path, cv2.IMREAD_UNCHANGED)
+
+    names, counts, mtimes = load_class_histogram(dataset_path)
+    index = {name: (row, mtime) for name, row, mtime in zip(names, counts, mtimes)}
+
+    mask_paths = sorted(glob(os.path.join(dataset_path, "masks", "*.png")))
+    current = {os.path.splitext(os.path.basename(p))[0]: p for p in mask_paths}
+    stale = [
+        name for name, p in current.items()
+        if name not in index or index[name][1] != os.path.getmtime(p)
+    ]
+    removed = [name for name in index if name not in current]
+
+    if stale:
+        print(f"Updating class histogram index: {len(stale)} new or modified masks")
+        for name in tqdm(stale):
+            p = current[name]
+            index[name] = (mask_histogram(read_mask(p)), os.path.getmtime(p))
+    for name in removed:
+        del index[name]
+    if stale or removed:
+        names = list(index)
+        save_class_histogram(dataset_path, names, [index[n][0] for n in names], [index[n][1] for n in names])
+
+    names = sorted(index)
+    return np.array(names), np.array([index[n][0] for n in names], dtype=np.int64).reshape(-1, NUM_CLASSES)
+
+# ---------------- DERIVED WEIGHTS ----------------
+def class_weights(counts, method="inverse_frequency", beta=0.999):
+    """Per-class weights (mean 1) from a per-image pixel count table.
+
+    inverse_frequency: total pixels / class pixels
+    effective_number:  (1 - beta) / (1 - beta^n), n = images containing the class (Cui et al.)
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    if method == "inverse_frequency":
+        pixels = np.maximum(counts.sum(axis=0), 1.0)
+        weights = pixels.sum() / pixels
+    elif method == "effective_number":
+        images = (counts > 0).sum(axis=0)
+        weights = (1.0 - beta) / np.maximum(1.0 - np.power(beta, images), 1e-12)
+    else:
+        raise ValueError(f"Unknown class weight method {method}, expected one of {WEIGHT_METHODS}")
+    return weights / weights.mean()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or update the per-image class histogram index")
+    parser.add_argument("--path", default="./post_dataset_taco", help="dataset folder containing masks/")
+    args = parser.parse_args()
+
+    names, counts = update_class_histogram(args.path)
+    total = counts.sum(axis=0)
+    print(f"Images: {len(names)}")
+    for c in range(NUM_CLASSES):
+        print(f"Class {c}: {total[c]} pixels ({total[c] / max(total.sum(), 1):.4f}), "
+              f"in {(counts[:, c] > 0).sum()} images")
+    for method in WEIGHT_METHODS:
+        print(f"{method}: {np.round(class_weights(counts, method), 3).tolist()}")
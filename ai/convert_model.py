@@ -1,22 +1,166 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
 import tensorflow as tf
-from metrics import combined_loss, dice_coef_multi, pixel_precision, per_class_precision
-
-# Load model
-model = tf.keras.models.load_model(
-    "./results/Unet_v3_CompoundLoss/Unet_v3_CompoundLoss.h5",
-    custom_objects={
-        "combined_loss": combined_loss,
-        "dice_coef_multi": dice_coef_multi,
-        "pixel_precision": pixel_precision,
-        "per_class_precision": per_class_precision
+import yaml
+from tqdm import tqdm
+
+import train
+from train import NUM_CLASSES, PACKED_DIR, load_dataset, load_packed_dataset, read_image, read_mask, read_packed
+from metrics import confusion_matrices
+from inference_backends import load_keras_model, TFLitePredictor
+
+# ---------------- PARAMETERS ----------------
+MODES = ["float32", "float16", "int8"]
+DATASET_PATH = "./post_dataset_taco"
+SEED = 42
+
+def read_config(file_path):
+    with open(file_path, 'r') as file:
+        try:
+            return yaml.safe_load(file)
+        except yaml.YAMLError as exc:
+            print(f"Error reading YAML file: {exc}")
+            return None
+
+def tflite_path(model_name, mode):
+    """float32 keeps the original file name, quantized models get the mode as suffix"""
+    suffix = "" if mode == "float32" else f"_{mode}"
+    return os.path.join("results", model_name, f"{model_name}{suffix}.tflite")
+
+# ---------------- DATA ----------------
+def load_splits(config_params):
+    if config_params.get("packed", False):
+        return load_packed_dataset(os.path.join(DATASET_PATH, PACKED_DIR))
+    return load_dataset(DATASET_PATH)
+
+def read_sample(x, y):
+    """Image (float32 BGR in [0, 1]) and (H, W) class mask, preprocessed exactly as in training"""
+    if train.PACKED is not None:
+        image, mask = read_packed(x)
+    else:
+        image, mask = read_image(x), read_mask(y)
+    return image, mask[:, :, 0]
+
+def representative_dataset(train_x, train_y, num_samples):
+    """Calibration images drawn from the train split"""
+    rng = np.random.default_rng(SEED)
+    picks = rng.choice(len(train_x), size=min(num_samples, len(train_x)), replace=False)
+
+    def generator():
+        for i in tqdm(picks, desc="Calibration"):
+            image, _ = read_sample(train_x[i], train_y[i])
+            yield [image[np.newaxis]]
+    return generator
+
+# ---------------- CONVERSION ----------------
+def convert(model, mode, calibration=None):
+    # Static batch-1 signature: the phone runs single frames, and the dynamic reshapes of
+    # GroupNormalization fail to prepare in the interpreter with an unknown batch size
+    input_spec = tf.TensorSpec([1] + list(model.input.shape[1:]), tf.float32)
+    concrete = tf.function(lambda x: model(x, training=False)).get_concrete_function(input_spec)
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([concrete], model)
+    if mode == "float32":
+        converter.optimizations = []  # no quantization
+    elif mode == "float16":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif mode == "int8":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = calibration
+        # int8 kernels wherever they exist, float fallback for the rest (e.g. GroupNorm parts);
+        # input/output stay float32 so Classifier.cs feeds the model unchanged
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8, tf.lite.OpsSet.TFLITE_BUILTINS]
+    else:
+        raise ValueError(f"Unknown mode {mode}, expected one of {MODES}")
+    return converter.convert()
+
+# ---------------- EVALUATION ----------------
+def confusion_matrix_of(predict, X, Y, batch_size):
+    """Confusion matrix over (X, Y) for predict(images) -> probabilities"""
+    cm = np.zeros((NUM_CLASSES, NUM_CLASSES), dtype=np.int64)
+    for start in tqdm(range(0, len(X), batch_size), desc="Evaluation"):
+        samples = [read_sample(x, y) for x, y in zip(X[start:start + batch_size], Y[start:start + batch_size])]
+        images = np.stack([s[0] for s in samples])
+        masks = np.stack([s[1] for s in samples])
+        preds = np.argmax(predict(images), axis=-1)
+        cm += confusion_matrices(masks, preds, NUM_CLASSES).sum(axis=0)
+    return cm
+
+def per_class_iou(cm):
+    tp = np.diag(cm).astype(np.float64)
+    union = cm.sum(axis=0) + cm.sum(axis=1) - tp
+    return np.divide(tp, union, out=np.zeros_like(tp), where=union > 0)
+
+def tflite_latency_ms(predictor, image, runs=50, warmup=5):
+    """Median and p90 single-image latency of the TFLite interpreter"""
+    x = image[np.newaxis]
+    for _ in range(warmup):
+        predictor.predict(x)
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        predictor.predict(x)
+        times.append(time.perf_counter() - start)
+    return 1000 * float(np.median(times)), 1000 * float(np.percentile(times, 90))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a trained model to TFLite (float32, float16 or int8)")
+    parser.add_argument("config", help="YAML config of the model (results/<name>/<name>.h5)")
+    parser.add_argument("--mode", choices=MODES, default="float32")
+    parser.add_argument("--calibration-samples", type=int, default=200, help="train images used to calibrate int8")
+    parser.add_argument("--eval-samples", type=int, default=None, help="test images for the IoU comparison (default: all)")
+    parser.add_argument("--batch-size", type=int, default=8, help="Keras batch size during evaluation")
+    parser.add_argument("--threads", type=int, default=None, help="TFLite interpreter threads")
+    parser.add_argument("--latency-runs", type=int, default=50)
+    parser.add_argument("--skip-eval", action="store_true", help="only convert and report size/latency")
+    args = parser.parse_args()
+
+    config_params = read_config(args.config)
+    if config_params is None:
+        raise Exception("Could not read the config file!")
+    model_name = config_params["name"]
+    model_path = os.path.join("results", model_name, f"{model_name}.h5")
+    out_path = tflite_path(model_name, args.mode)
+
+    model = load_keras_model(model_path, compile=False)
+    (train_x, train_y), _, (test_x, test_y) = load_splits(config_params)
+
+    calibration = None
+    if args.mode == "int8":
+        calibration = representative_dataset(train_x, train_y, args.calibration_samples)
+    tflite_model = convert(model, args.mode, calibration)
+    with open(out_path, "wb") as f:
+        f.write(tflite_model)
+
+    report = {
+        "mode": args.mode,
+        "tflite_path": out_path,
+        "keras_size_mb": os.path.getsize(model_path) / 2**20,
+        "tflite_size_mb": len(tflite_model) / 2**20,
     }
-)
+    print(f"Saved {out_path}: {report['tflite_size_mb']:.2f} MB (Keras .h5: {report['keras_size_mb']:.2f} MB)")
+
+    predictor = TFLitePredictor(out_path, num_threads=args.threads)
+    if len(test_x):
+        sample_image, _ = read_sample(test_x[0], test_y[0])
+        report["latency_ms_p50"], report["latency_ms_p90"] = tflite_latency_ms(predictor, sample_image, args.latency_runs)
+        print(f"TFLite CPU latency (batch 1): p50 {report['latency_ms_p50']:.1f} ms, p90 {report['latency_ms_p90']:.1f} ms")
+
+    if not args.skip_eval and len(test_x):
+        X, Y = test_x[:args.eval_samples], test_y[:args.eval_samples]
+        keras_iou = per_class_iou(confusion_matrix_of(lambda x: model.predict_on_batch(x), X, Y, args.batch_size))
+        tflite_iou = per_class_iou(confusion_matrix_of(predictor.predict, X, Y, 1))
+        report["keras_iou"] = keras_iou.tolist()
+        report["tflite_iou"] = tflite_iou.tolist()
 
-# Convert to TFLite
-converter = tf.lite.TFLiteConverter.from_keras_model(model)
-converter.optimizations = []  # no quantization, safest
-tflite_model = converter.convert()
+        print(f"\n--- Per-class IoU on {len(X)} test images (Keras vs TFLite {args.mode}) ---")
+        for c in range(NUM_CLASSES):
+            print(f"Class {c}: {keras_iou[c]:.4f} -> {tflite_iou[c]:.4f} ({tflite_iou[c] - keras_iou[c]:+.4f})")
+        print(f"Mean foreground: {keras_iou[1:].mean():.4f} -> {tflite_iou[1:].mean():.4f} "
+              f"({tflite_iou[1:].mean() - keras_iou[1:].mean():+.4f})")
 
-# Save
-with open("./results/Unet_v3_CompoundLoss/Unet_v3_CompoundLoss.tflite", "wb") as f:
-    f.write(tflite_model)
+    with open(os.path.join("results", model_name, f"conversion_{args.mode}.json"), "w") as f:
+        json.dump(report, f, indent=2)
@@ -1,40 +1,157 @@
+import os
+import argparse
+from glob import glob
+import numpy as np
 import tensorflow as tf
 import tf2onnx
 import onnx
+import onnxruntime as ort
+import cv2
+import yaml
+
+from inference_backends import load_keras_model
 
 # =========================
 # CONFIGURARE
 # =========================
-H5_MODEL_PATH = "./results/Unet_v3_CompoundLoss/Unet_v3_CompoundLoss.h5"
-ONNX_OUTPUT_PATH = "./results/Unet_v3_CompoundLoss/Unet_v3_CompoundLoss.onnx"
-
-# 🔒 FIXED INPUT SHAPE
+# 🔒 FIXED INPUT SHAPE (the batch can be made symbolic with --dynamic-batch)
 BATCH_SIZE = 1
 HEIGHT = 256
 WIDTH = 256
 CHANNELS = 3
 
 OPSET = 13
+# ORT "extended" level: constant folding plus Conv/activation and other node fusions, still
+# portable across CPUs (the "all" level adds layout changes tied to the exporting machine)
+OPTIMIZATION_LEVELS = {"basic": "ORT_ENABLE_BASIC", "extended": "ORT_ENABLE_EXTENDED"}
+DATASET_PATH = "./post_dataset_taco"
+
+parser = argparse.ArgumentParser(description="Export a trained model to ONNX, optionally with pre/postprocessing in the graph")
+parser.add_argument("config", help="YAML config of the model (results/<name>/<name>.h5)")
+parser.add_argument("--input-dtype", choices=["float32", "uint8"], default="float32",
+                    help="uint8: raw camera pixels, the /255 normalization runs in the graph")
+parser.add_argument("--layout", choices=["nhwc", "nchw"], default="nhwc")
+parser.add_argument("--channel-order", choices=["bgr", "rgb"], default="bgr",
+                    help="channel order of the input; the model was trained on BGR (cv2), rgb is reordered in the graph")
+parser.add_argument("--input-size", type=int, nargs=2, metavar=("HEIGHT", "WIDTH"), default=None,
+                    help="input resolution, resized to 256x256 in the graph (default: 256 256, no resize)")
+parser.add_argument("--head", choices=["softmax", "argmax"], default="softmax",
+                    help="argmax: uint8 class map + max-confidence map instead of per-class probabilities")
+parser.add_argument("--confidence-dtype", choices=["uint8", "float16"], default="uint8",
+                    help="confidence output of the argmax head (uint8: 0..255 for 0..1)")
+parser.add_argument("--dynamic-batch", action="store_true", help="symbolic batch dimension instead of batch 1")
+parser.add_argument("--opset", type=int, default=OPSET)
+parser.add_argument("--optimize", choices=list(OPTIMIZATION_LEVELS), default=None,
+                    help="also save an onnxruntime-optimized copy as <output>_opt.onnx")
+parser.add_argument("--output", default=None, help="default: results/<name>/<name>.onnx")
+parser.add_argument("--parity-samples", type=int, default=20,
+                    help="test images compared against the Keras model after export (0 to skip)")
+args = parser.parse_args()
+
+with open(args.config, "r") as f:
+    config_params = yaml.safe_load(f)
+model_name = config_params["name"]
+H5_MODEL_PATH = os.path.join("results", model_name, f"{model_name}.h5")
+ONNX_OUTPUT_PATH = args.output or os.path.join("results", model_name, f"{model_name}.onnx")
+IN_HEIGHT, IN_WIDTH = args.input_size or (HEIGHT, WIDTH)
 
 # =========================
 # LOAD MODEL (.h5)
 # =========================
 print("[INFO] Loading Keras model...")
-model = tf.keras.models.load_model(
-    H5_MODEL_PATH,
-    compile=False   # 🔴 IMPORTANT (ignora loss / metrics custom)
-)
+model = load_keras_model(H5_MODEL_PATH, compile=False)  # 🔴 IMPORTANT (ignora loss / metrics custom)
 
 print("[INFO] Model loaded")
 print("[INFO] Keras input shape:", model.input_shape)
 
 # =========================
-# DEFINE FIXED SHAPE
+# EXPORT-FRIENDLY GROUPNORM
+# =========================
+# Keras GroupNormalization reshapes with runtime shapes, which tf2onnx turns into ~50
+# Shape/Slice/Concat/Where nodes per layer that no ONNX optimizer can fold. Here the group
+# statistics are per-channel means averaged within each group by a constant 1x1 conv: no
+# reshape, so tf2onnx keeps the whole network in NCHW without a Transpose around every conv.
+class ExportGroupNorm(tf.keras.layers.Layer):
+    def __init__(self, groups, epsilon, **kwargs):
+        super().__init__(**kwargs)
+        self.groups = groups
+        self.epsilon = epsilon
+
+    def build(self, input_shape):
+        channels = input_shape[-1]
+        self.gamma = self.add_weight(name="gamma", shape=(channels,), initializer="ones")
+        self.beta = self.add_weight(name="beta", shape=(channels,), initializer="zeros")
+        size = channels // self.groups
+        group_mean = np.kron(np.eye(self.groups), np.full((size, size), 1.0 / size))
+        self.group_mean = group_mean.reshape(1, 1, channels, channels).astype(np.float32)
+        # Per-channel epsilon: tf2onnx's transpose optimizer fails on Add with a scalar constant
+        self.epsilon_vector = np.full(channels, self.epsilon, dtype=np.float32)
+        super().build(input_shape)
+
+    def _group_average(self, x):
+        return tf.nn.conv2d(x, tf.constant(self.group_mean), strides=1, padding="VALID")
+
+    def call(self, x):
+        mean = self._group_average(tf.reduce_mean(x, axis=[1, 2], keepdims=True))
+        centered = x - mean
+        variance = self._group_average(tf.reduce_mean(tf.square(centered), axis=[1, 2], keepdims=True))
+        return centered * (tf.math.rsqrt(variance + tf.constant(self.epsilon_vector)) * self.gamma) + self.beta
+
+def export_friendly(keras_model):
+    def swap(layer):
+        if isinstance(layer, tf.keras.layers.GroupNormalization) and layer.center and layer.scale:
+            return ExportGroupNorm(layer.groups, layer.epsilon, name=layer.name)
+        return layer.__class__.from_config(layer.get_config())
+    clone = tf.keras.models.clone_model(keras_model, clone_function=swap)
+    clone.set_weights(keras_model.get_weights())
+    return clone
+
+export_net = export_friendly(model)
+
+# =========================
+# PRE/POSTPROCESSING IN THE GRAPH
+# =========================
+# Everything Classifier.cs does per pixel on the CPU (normalize, reorder, resize, argmax)
+# runs here as part of the model, on the inference backend
+def preprocess(x):
+    """Exported input -> float32 NHWC BGR 256x256 in [0, 1], as read_image produces it"""
+    x = tf.cast(x, tf.float32)
+    if args.layout == "nchw":
+        x = tf.transpose(x, [0, 2, 3, 1])
+    if args.channel_order == "rgb":
+        x = tf.reverse(x, axis=[-1])
+    if (IN_HEIGHT, IN_WIDTH) != (HEIGHT, WIDTH):
+        x = tf.image.resize(x, (HEIGHT, WIDTH), method="bilinear")  # same as cv2.INTER_LINEAR
+    if args.input_dtype == "uint8":
+        x = x / 255.0
+    return x
+
+def postprocess(probs):
+    if args.head == "softmax":
+        return {"probabilities": probs}
+    class_map = tf.cast(tf.argmax(probs, axis=-1), tf.uint8)
+    confidence = tf.reduce_max(probs, axis=-1)
+    if args.confidence_dtype == "uint8":
+        confidence = tf.cast(tf.round(confidence * 255.0), tf.uint8)
+    else:
+        confidence = tf.cast(confidence, tf.float16)
+    return {"class_map": class_map, "confidence": confidence}
+
+def export_model(x):
+    return postprocess(export_net(preprocess(x), training=False))
+
+# =========================
+# DEFINE INPUT SHAPE
 # =========================
+batch = None if args.dynamic_batch else BATCH_SIZE
+if args.layout == "nchw":
+    input_shape = [batch, CHANNELS, IN_HEIGHT, IN_WIDTH]
+else:
+    input_shape = [batch, IN_HEIGHT, IN_WIDTH, CHANNELS]
 input_signature = (
     tf.TensorSpec(
-        [BATCH_SIZE, HEIGHT, WIDTH, CHANNELS],
-        tf.float32,
+        input_shape,
+        tf.uint8 if args.input_dtype == "uint8" else tf.float32,
         name="input"
     ),
 )
@@ -42,15 +159,23 @@ input_signature = (
 # =========================
 # CONVERT TO ONNX
 # =========================
-print("[INFO] Converting to ONNX with FIXED SHAPE...")
+print(f"[INFO] Converting to ONNX (opset {args.opset}) with input {input_shape} ({args.input_dtype}, "
+      f"{args.channel_order}), {args.head} head...")
 
-tf2onnx.convert.from_keras(
-    model,
+onnx_model, _ = tf2onnx.convert.from_function(
+    tf.function(export_model),
     input_signature=input_signature,
-    opset=OPSET,
-    output_path=ONNX_OUTPUT_PATH
+    opset=args.opset
 )
 
+# Export options travel with the file, so inference_backends.ONNXPredictor can feed it correctly
+onnx.helper.set_model_props(onnx_model, {
+    "channel_order": args.channel_order,
+    "head": args.head,
+    "confidence_dtype": args.confidence_dtype,
+})
+onnx.save(onnx_model, ONNX_OUTPUT_PATH)
+
 print("[INFO] ONNX model saved to:", ONNX_OUTPUT_PATH)
 
 # =========================
@@ -61,8 +186,77 @@ print("[INFO] Verifying ONNX input shape...")
 onnx_model = onnx.load(ONNX_OUTPUT_PATH)
 onnx.checker.check_model(onnx_model)
 
+def dims_of(value_info):
+    return [d.dim_param or d.dim_value for d in value_info.type.tensor_type.shape.dim]
+
 for inp in onnx_model.graph.input:
-    dims = [d.dim_value for d in inp.type.tensor_type.shape.dim]
-    print("ONNX input:", inp.name, dims)
+    print("ONNX input:", inp.name, dims_of(inp))
+for out in onnx_model.graph.output:
+    print("ONNX output:", out.name, dims_of(out), onnx.TensorProto.DataType.Name(out.type.tensor_type.elem_type))
+
+print(f"[SUCCESS] ONNX model is VALID ({'dynamic batch' if args.dynamic_batch else 'FIXED SHAPE'})")
+
+# =========================
+# GRAPH OPTIMIZATION
+# =========================
+shipped_path = ONNX_OUTPUT_PATH
+if args.optimize:
+    optimized_path = os.path.splitext(ONNX_OUTPUT_PATH)[0] + "_opt.onnx"
+    options = ort.SessionOptions()
+    options.graph_optimization_level = getattr(ort.GraphOptimizationLevel, OPTIMIZATION_LEVELS[args.optimize])
+    options.optimized_model_filepath = optimized_path
+    ort.InferenceSession(ONNX_OUTPUT_PATH, options, providers=["CPUExecutionProvider"])
+
+    optimized = onnx.load(optimized_path)
+    print(f"[INFO] Optimized ({args.optimize}) model saved to: {optimized_path}, "
+          f"{len(onnx_model.graph.node)} -> {len(optimized.graph.node)} nodes")
+    shipped_path = optimized_path
+
+# =========================
+# PARITY WITH KERAS
+# =========================
+# Test images go through the exported graph as the app would feed them (camera resolution,
+# dtype, layout, channel order) and through the Keras model with the training preprocessing.
+# The optimized copy is checked when there is one, as that is the file that gets shipped.
+run_parity = args.parity_samples > 0
+if run_parity and not glob(os.path.join(DATASET_PATH, "images", "*.png")):
+    # Export-only machines usually have no dataset, the exported files are complete without the check
+    print(f"[INFO] Parity check skipped: no images in {DATASET_PATH} (--parity-samples 0 to silence this)")
+    run_parity = False
+
+if run_parity:
+    from train import load_dataset
+
+    print(f"[INFO] Parity check of {shipped_path}")
+    session = ort.InferenceSession(shipped_path, providers=["CPUExecutionProvider"])
+    input_name = session.get_inputs()[0].name
+    output_names = [o.name for o in session.get_outputs()]
+
+    _, _, (test_x, _) = load_dataset(DATASET_PATH)
+    agreement, max_diff = [], 0.0
+    for path in test_x[:args.parity_samples]:
+        camera = cv2.resize(cv2.imread(path, cv2.IMREAD_COLOR), (IN_WIDTH, IN_HEIGHT))  # BGR uint8
+
+        reference = cv2.resize(camera, (WIDTH, HEIGHT)).astype(np.float32) / 255.0
+        probs = model.predict_on_batch(reference[np.newaxis])
+
+        x = camera[:, :, ::-1] if args.channel_order == "rgb" else camera
+        x = x.astype(np.uint8) if args.input_dtype == "uint8" else x.astype(np.float32) / 255.0
+        if args.layout == "nchw":
+            x = x.transpose(2, 0, 1)
+        outputs = dict(zip(output_names, session.run(None, {input_name: np.ascontiguousarray(x[np.newaxis])})))
+
+        if args.head == "softmax":
+            onnx_probs = outputs["probabilities"]
+            agreement.append(np.mean(np.argmax(onnx_probs, -1) == np.argmax(probs, -1)))
+            max_diff = max(max_diff, float(np.abs(onnx_probs - probs).max()))
+        else:
+            agreement.append(np.mean(outputs["class_map"] == np.argmax(probs, -1)))
+            confidence = outputs["confidence"].astype(np.float32)
+            if args.confidence_dtype == "uint8":
+                confidence /= 255.0
+            max_diff = max(max_diff, float(np.abs(confidence - probs.max(-1)).max()))
 
-print("[SUCCESS] ONNX model is VALID and FIXED SHAPE")
\ No newline at end of file
+    label = "probability" if args.head == "softmax" else "confidence"
+    print(f"[PARITY] {len(agreement)} test images: class agreement {100 * np.mean(agreement):.3f}% "
+          f"(min {100 * np.min(agreement):.3f}%), max {label} difference {max_diff:.2e}")
@@ -0,0 +1,20 @@
+import os
+import cv2
+
+# Only os and cv2, so the preprocessing pool workers can import it without TF/albumentations
+
+# JPEG can be decoded directly at 1/2, 1/4 or 1/8 scale (DCT scaling)
+REDUCED_READ_FLAGS = [
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+]
+
+def reduced_read_flag(file_name, width, height, target=256):
+    """(factor, cv2 flag) of the smallest reduced JPEG decode that still covers target x target;
+    (1, IMREAD_COLOR) for other formats or small images"""
+    if os.path.splitext(file_name)[1].lower() in (".jpg", ".jpeg"):
+        for factor, flag in REDUCED_READ_FLAGS:
+            if width // factor >= target and height // factor >= target:
+                return factor, flag
+    return 1, cv2.IMREAD_COLOR
@@ -1,14 +1,21 @@
 import albumentations as A
 from albumentations.core.transforms_interface import DualTransform
 import random
+import math
 import numpy as np
 import xml.etree.ElementTree as ET
 import cv2
+import tensorflow as tf
+
+from image_decode import reduced_read_flag
 
 IMAGE = 'image'
 TUMOR_MASK = 'tumorMask'
 
 TRANSFORM = None
+# "albumentations" runs TRANSFORM in numpy, "tensorflow" runs apply_tf_transform in the graph
+AUGMENTATION_BACKEND = "albumentations"
+TF_TRANSFORM = None
 
 class CustomCropNonEmptyMaskIfExists(DualTransform):
     def __init__(self, height, width, always_apply=False, p=1.0):
@@ -64,30 +71,50 @@ class CustomCropNonEmptyMaskIfExists(DualTransform):
         return ("height", "width")
 
 def init_transform(config_data):
-    global TRANSFORM
+    global TRANSFORM, TF_TRANSFORM, AUGMENTATION_BACKEND
     toTransform = []
+    tfTransform = {"horizontal_flip": False, "vertical_flip": False, "rotation": 0.0, "zoom": False}
     if "augmentation" in config_data:
+        AUGMENTATION_BACKEND = config_data["augmentation"].get("backend", "albumentations")
+        if AUGMENTATION_BACKEND not in ("albumentations", "tensorflow"):
+            raise Exception(f"Unknown augmentation backend {AUGMENTATION_BACKEND}!")
         if "flip" in config_data["augmentation"]:
             type = config_data["augmentation"]["flip"]
             if type == "horizontal":
                 toTransform.append(A.HorizontalFlip(p = 0.5))
+                tfTransform["horizontal_flip"] = True
             elif type == "vertical":
                 toTransform.append(A.VerticalFlip(p = 0.5))
+                tfTransform["vertical_flip"] = True
             elif type == "horizontal and vertical":
                 toTransform.append(A.HorizontalFlip(p = 0.5))
                 toTransform.append(A.VerticalFlip(p = 0.5))
+                tfTransform["horizontal_flip"] = True
+                tfTransform["vertical_flip"] = True
             else:
                 raise Exception("Wrong type of flip found!")
             print(f"Added flip({type}) to the model")
         if "rotation" in config_data["augmentation"]:
             rotation_value = float(config_data["augmentation"]["rotation"])
-            toTransform.append(A.Rotate(limit = (-rotation_value, rotation_value)))
+            rotate = A.Rotate(limit = (-rotation_value, rotation_value))
+            toTransform.append(rotate)
+            tfTransform["rotation"] = rotation_value
+            # The TF backend copies A.Rotate's default border, which depends on the albumentations
+            # version (reflect_101 in 1.x, constant 0 in 2.x)
+            tfTransform["rotation_border"] = rotate.border_mode
+            tfTransform["rotation_fill"] = float(getattr(rotate, "fill", getattr(rotate, "value", None)) or 0)
+            tfTransform["rotation_fill_mask"] = float(getattr(rotate, "fill_mask", getattr(rotate, "mask_value", None)) or 0)
             print(f"Added rotation({(-rotation_value, rotation_value)}) to the model")
         if "zoom" in config_data["augmentation"] and config_data["augmentation"]["zoom"]:
             toTransform.append(CustomCropNonEmptyMaskIfExists(height=160, width=160, p=0.75))
             toTransform.append(A.Resize(height=256, width=256))
+            tfTransform["zoom"] = True
             print("Added zoom (CustomCropNonEmptyMaskIfExists) to the model")
-        TRANSFORM = A.Compose(toTransform)
+        if AUGMENTATION_BACKEND == "tensorflow":
+            TF_TRANSFORM = tfTransform
+            print("Augmentation runs as TensorFlow graph ops")
+        else:
+            TRANSFORM = A.Compose(toTransform)
 
 def apply_transform(image, mask):
     if TRANSFORM == None:
@@ -97,6 +124,99 @@ def apply_transform(image, mask):
         }
     return TRANSFORM(image=image, mask=mask)
 
+# ---------------- TENSORFLOW AUGMENTATION ----------------
+# Graph-native versions of the albumentations pipeline above. They do not hold the GIL,
+# so they scale with num_parallel_calls and can be placed on an accelerator.
+def _random_flip(image, mask, flip_fn):
+    flip = tf.random.uniform([]) < 0.5
+    image = tf.cond(flip, lambda: flip_fn(image), lambda: image)
+    mask = tf.cond(flip, lambda: flip_fn(mask), lambda: mask)
+    return image, mask
+
+# cv2 border mode -> ImageProjectiveTransformV3 fill mode. BORDER_REFLECT_101 has no TF
+# counterpart (TF's REFLECT repeats the edge pixel, like cv2.BORDER_REFLECT), see _rotate
+TF_FILL_MODES = {
+    cv2.BORDER_CONSTANT: "CONSTANT",
+    cv2.BORDER_REFLECT: "REFLECT",
+    cv2.BORDER_REPLICATE: "NEAREST",
+    cv2.BORDER_WRAP: "WRAP",
+}
+
+def _rotate(x, angle, interpolation, border=cv2.BORDER_REFLECT_101, fill=0.0):
+    """Rotate [H, W, C] around the center by angle (radians) with the borders of cv2's border mode.
+    For BORDER_REFLECT_101 the image is padded with tf.pad's REFLECT (edge pixel excluded) and
+    the rotation samples the padded image."""
+    height, width = tf.shape(x)[0], tf.shape(x)[1]
+    pad_h = pad_w = 0
+    fill_mode = TF_FILL_MODES.get(border)
+    if border == cv2.BORDER_REFLECT_101:
+        pad_h = tf.minimum(height - 1, tf.maximum(height, width) // 2)
+        pad_w = tf.minimum(width - 1, tf.maximum(height, width) // 2)
+        x = tf.pad(x, [[pad_h, pad_h], [pad_w, pad_w], [0, 0]], mode="REFLECT")
+        fill_mode = "NEAREST"
+    elif fill_mode is None:
+        raise ValueError(f"Unsupported rotation border mode {border}")
+
+    h, w = tf.cast(height, tf.float32), tf.cast(width, tf.float32)
+    cos, sin = tf.cos(angle), tf.sin(angle)
+    x_offset = ((w - 1) - (cos * (w - 1) - sin * (h - 1))) / 2.0 + tf.cast(pad_w, tf.float32)
+    y_offset = ((h - 1) - (sin * (w - 1) + cos * (h - 1))) / 2.0 + tf.cast(pad_h, tf.float32)
+    transform = tf.stack([cos, -sin, x_offset, sin, cos, y_offset, 0.0, 0.0])[tf.newaxis]
+    return tf.raw_ops.ImageProjectiveTransformV3(
+        images=x[tf.newaxis], transforms=transform, output_shape=tf.stack([height, width]),
+        fill_value=fill, interpolation=interpolation, fill_mode=fill_mode
+    )[0]
+
+def _random_rotate(image, mask, limit, border=cv2.BORDER_REFLECT_101, fill=0.0, fill_mask=0.0, p=0.5):
+    """Same as A.Rotate with the given border: rotate around the center"""
+    angle = tf.random.uniform([], -limit, limit) * math.pi / 180.0
+    rotate = tf.random.uniform([]) < p
+    image = tf.cond(rotate, lambda: _rotate(image, angle, "BILINEAR", border, fill), lambda: image)
+    mask = tf.cond(rotate, lambda: _rotate(mask, angle, "NEAREST", border, fill_mask), lambda: mask)
+    return image, mask
+
+def _random_zoom(image, mask, size=160, p=0.75):
+    """Same as CustomCropNonEmptyMaskIfExists + A.Resize: crop around a random foreground pixel"""
+    height, width = tf.shape(mask)[0], tf.shape(mask)[1]
+    foreground = tf.where(mask[:, :, 0] > 0)
+
+    def _around_foreground():
+        idx = tf.random.uniform([], 0, tf.shape(foreground)[0], dtype=tf.int32)
+        yx = tf.cast(foreground[idx], tf.int32)
+        return yx[0] - size // 2, yx[1] - size // 2
+
+    def _anywhere():
+        y_min = tf.random.uniform([], 0, height - size + 1, dtype=tf.int32)
+        x_min = tf.random.uniform([], 0, width - size + 1, dtype=tf.int32)
+        return y_min, x_min
+
+    def _crop():
+        y_min, x_min = tf.cond(tf.shape(foreground)[0] > 0, _around_foreground, _anywhere)
+        y_min = tf.clip_by_value(y_min, 0, height - size)
+        x_min = tf.clip_by_value(x_min, 0, width - size)
+        return image[y_min:y_min + size, x_min:x_min + size], mask[y_min:y_min + size, x_min:x_min + size]
+
+    crop = tf.random.uniform([]) < p
+    image, mask = tf.cond(crop, _crop, lambda: (image, mask))
+    image = tf.image.resize(image, (256, 256), method="bilinear")
+    mask = tf.image.resize(mask, (256, 256), method="nearest")
+    return image, mask
+
+def apply_tf_transform(image, mask):
+    """Augment a float32 (H, W, 3) image and uint8 (H, W, 1) class mask with TensorFlow ops"""
+    if TF_TRANSFORM is None:
+        return image, mask
+    if TF_TRANSFORM["horizontal_flip"]:
+        image, mask = _random_flip(image, mask, tf.image.flip_left_right)
+    if TF_TRANSFORM["vertical_flip"]:
+        image, mask = _random_flip(image, mask, tf.image.flip_up_down)
+    if TF_TRANSFORM["rotation"] > 0:
+        image, mask = _random_rotate(image, mask, TF_TRANSFORM["rotation"], TF_TRANSFORM["rotation_border"],
+                                     TF_TRANSFORM["rotation_fill"], TF_TRANSFORM["rotation_fill_mask"])
+    if TF_TRANSFORM["zoom"]:
+        image, mask = _random_zoom(image, mask)
+    return image, mask
+
 def map_to_interval(arr):
     # Flatten the array to 1D
     flattened_arr = arr.flatten()
@@ -114,10 +234,6 @@ def map_to_interval(arr):
     return mapped_arr
 
 def get_image_mask(image_file_path, data_file_path):
-    # Read image
-    image = cv2.imread(image_file_path)
-    height, width = image.shape[:2]
-
     # Parse XML
     tree = ET.parse(data_file_path)
     root = tree.getroot()
@@ -127,6 +243,23 @@ def get_image_mask(image_file_path, data_file_path):
     xmax = int(float(bndbox.find('xmax').text))
     ymax = int(float(bndbox.find('ymax').text))
 
+    # Read image, reduced decode needs the original size recorded in the annotation
+    factor, flag = 1, cv2.IMREAD_COLOR
+    size = root.find('size')
+    if size is not None:
+        orig_width = int(float(size.find('width').text))
+        orig_height = int(float(size.find('height').text))
+        factor, flag = reduced_read_flag(image_file_path, orig_width, orig_height)
+    image = cv2.imread(image_file_path, flag)
+    height, width = image.shape[:2]
+
+    # Bounding box is in original pixels, rescale it to the decoded image
+    if factor > 1:
+        scale_x = width / orig_width
+        scale_y = height / orig_height
+        xmin, xmax = int(xmin * scale_x), int(round(xmax * scale_x))
+        ymin, ymax = int(ymin * scale_y), int(round(ymax * scale_y))
+
     # Create mask
     mask = np.zeros((height, width), dtype=np.uint8)
     mask[ymin:ymax, xmin:xmax] = 255
@@ -0,0 +1,167 @@
+import os
+import numpy as np
+import tensorflow as tf
+import cv2
+
+from metrics import dice_coef_multi, combined_loss, pixel_precision, per_class_precision
+from ConfusionMatrixMetric import ConfusionMatrixMetric
+from unet import ConvBlock
+
+BACKENDS = ["keras", "onnx", "tflite"]
+ARTIFACT_EXTENSIONS = {"keras": ".h5", "onnx": ".onnx", "tflite": ".tflite"}
+
+# Everything needed to deserialize a model saved by train.py
+CUSTOM_OBJECTS = {
+    "combined_loss": combined_loss,
+    "dice_coef_multi": dice_coef_multi,
+    "pixel_precision": pixel_precision,
+    "per_class_precision": per_class_precision,
+    "ConfusionMatrixMetric": ConfusionMatrixMetric,
+    "ConvBlock": ConvBlock,
+}
+
+def load_keras_model(path, compile=True):
+    with tf.keras.utils.CustomObjectScope(CUSTOM_OBJECTS):
+        return tf.keras.models.load_model(path, compile=compile)
+
+def normalize(images):
+    """uint8 BGR images -> float32 in [0, 1], rounded exactly like test.py always did"""
+    return (np.asarray(images, dtype=np.float64) / 255.0).astype(np.float32)
+
+# ---------------- PREDICTORS ----------------
+# Every backend takes the same input: predict() float32 [B, H, W, 3] BGR images in [0, 1]
+# -> float32 [B, H, W, C] probabilities (as model.predict), predict_classes() uint8 BGR
+# images -> [B, H, W] class map. Scoring code does not need to know what runs underneath.
+class Predictor:
+    def predict(self, images):
+        raise NotImplementedError
+
+    def predict_classes(self, images):
+        return np.argmax(self.predict(normalize(images)), axis=-1)
+
+class KerasPredictor(Predictor):
+    """Trained .h5 model, run as one tf.function per batch shape"""
+    def __init__(self, model_path):
+        self.model = load_keras_model(model_path)
+        self._predict = tf.function(lambda x: self.model(x, training=False), reduce_retracing=True)
+        self._classes = tf.function(self._classes_graph, reduce_retracing=True)
+
+    def _classes_graph(self, images):
+        x_input = tf.cast(tf.cast(images, tf.float64) / 255.0, tf.float32)
+        return tf.argmax(self.model(x_input, training=False), axis=-1)
+
+    def predict(self, images):
+        return self._predict(tf.convert_to_tensor(images, dtype=tf.float32)).numpy()
+
+    def predict_classes(self, images):
+        return self._classes(tf.convert_to_tensor(images)).numpy()
+
+class ONNXPredictor(Predictor):
+    """ONNX model from convert_to_onnx.py, any of its export options. The input dtype, layout,
+    size and batch come from the graph, channel order and head from the model metadata."""
+    def __init__(self, model_path, num_threads=None):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input = self.session.get_inputs()[0]
+        self.output_names = [o.name for o in self.session.get_outputs()]
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.rgb = metadata.get("channel_order", "bgr") == "rgb"
+        self.head = metadata.get("head", "softmax")
+
+        shape = self.input.shape
+        self.nchw = shape[1] == 3
+        self.size = tuple(shape[2:4]) if self.nchw else tuple(shape[1:3])
+        self.batch = shape[0] if isinstance(shape[0], int) else None  # None: dynamic batch
+        self.uint8 = self.input.type == "tensor(uint8)"
+
+    def _prepare(self, x):
+        """BGR NHWC batch (already in the input dtype) -> the exported input"""
+        if tuple(x.shape[1:3]) != self.size:
+            x = np.stack([cv2.resize(image, self.size[::-1]) for image in x])
+        if self.rgb:
+            x = x[..., ::-1]
+        if self.nchw:
+            x = x.transpose(0, 3, 1, 2)
+        return np.ascontiguousarray(x)
+
+    def _run(self, x):
+        chunk = self.batch or len(x)
+        outputs = [self.session.run(None, {self.input.name: x[i:i + chunk]}) for i in range(0, len(x), chunk)]
+        return {name: np.concatenate([o[k] for o in outputs]) for k, name in enumerate(self.output_names)}
+
+    def predict(self, images):
+        if self.head != "softmax":
+            raise ValueError("This ONNX model has an argmax head, only predict_classes is available")
+        x = np.asarray(images, dtype=np.float32)
+        if self.uint8:
+            x = np.clip(np.round(x * 255.0), 0, 255).astype(np.uint8)
+        return self._run(self._prepare(x))["probabilities"]
+
+    def predict_classes(self, images):
+        x = np.asarray(images, dtype=np.uint8)
+        outputs = self._run(self._prepare(x if self.uint8 else normalize(x)))
+        if self.head == "softmax":
+            return np.argmax(outputs["probabilities"], axis=-1)
+        return outputs["class_map"]
+
+# ---------------- TFLITE ----------------
+class TFLitePredictor(Predictor):
+    """Runs a .tflite segmentation model: float32 [B, H, W, 3] images in [0, 1] -> float32
+    [B, H, W, C] probabilities, as model.predict does. Quantized input/output tensors are
+    (de)quantized here, so callers never see the integer representation. Models exported
+    with a static batch (convert_model.py) run the batch in chunks of that size."""
+    def __init__(self, model_path, num_threads=None):
+        self.interpreter = tf.lite.Interpreter(model_path=model_path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self._refresh()
+        self.dynamic_batch = self.input["shape_signature"][0] == -1
+
+    def _refresh(self):
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+
+    def _resize(self, batch):
+        if self.input["shape"][0] != batch:
+            shape = [batch] + list(self.input["shape"][1:])
+            self.interpreter.resize_tensor_input(self.input["index"], shape)
+            self.interpreter.allocate_tensors()
+            self._refresh()
+
+    def _invoke(self, images):
+        x = images
+        if self.input["dtype"] != np.float32:
+            scale, zero_point = self.input["quantization"]
+            info = np.iinfo(self.input["dtype"])
+            x = np.clip(np.round(images / scale + zero_point), info.min, info.max).astype(self.input["dtype"])
+        self.interpreter.set_tensor(self.input["index"], x)
+        self.interpreter.invoke()
+
+        y = self.interpreter.get_tensor(self.output["index"])
+        if self.output["dtype"] != np.float32:
+            scale, zero_point = self.output["quantization"]
+            y = (y.astype(np.float32) - zero_point) * scale
+        return y
+
+    def predict(self, images):
+        images = np.asarray(images, dtype=np.float32)
+        if self.dynamic_batch:
+            self._resize(len(images))
+            return self._invoke(images)
+        chunk = self.input["shape"][0]
+        return np.concatenate([self._invoke(images[i:i + chunk]) for i in range(0, len(images), chunk)])
+
+def default_artifact(model_name, backend):
+    return os.path.join("results", model_name, f"{model_name}{ARTIFACT_EXTENSIONS[backend]}")
+
+def load_predictor(backend, model_path, num_threads=None):
+    if backend == "keras":
+        return KerasPredictor(model_path)
+    if backend == "onnx":
+        return ONNXPredictor(model_path, num_threads)
+    if backend == "tflite":
+        return TFLitePredictor(model_path, num_threads)
+    raise ValueError(f"Unknown backend {backend}, expected one of {BACKENDS}")
@@ -0,0 +1,61 @@
+import os
+import resource
+import tensorflow as tf
+
+# Numbers come from the TF allocator on GPU, and on CPU when TF_CPU_ALLOCATOR_USE_BFC=true
+# is set before TensorFlow starts. Otherwise the CPU allocator reports nothing, and the
+# process RSS from /proc is used instead (Linux, as in the training container).
+
+def _gpu():
+    return bool(tf.config.list_physical_devices("GPU"))
+
+def _allocator_device():
+    if _gpu():
+        return "GPU:0"
+    if os.environ.get("TF_CPU_ALLOCATOR_USE_BFC", "").lower() in ("1", "true"):
+        return "CPU:0"
+    return None
+
+def _proc_status_mb(field):
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024  # kB
+    except OSError:
+        pass
+    return None
+
+def memory_kind():
+    device = _allocator_device()
+    return device.split(":")[0] + " allocator" if device else "RSS"
+
+def reset_peak_memory():
+    """Start a new peak measurement window"""
+    device = _allocator_device()
+    if device:
+        tf.config.experimental.reset_memory_stats(device)
+        return
+    try:
+        # Writing 5 resets the peak RSS (VmHWM) of the process
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def current_memory_mb():
+    device = _allocator_device()
+    if device:
+        return tf.config.experimental.get_memory_info(device)["current"] / 2**20
+    current = _proc_status_mb("VmRSS")
+    return current if current is not None else peak_memory_mb()
+
+def peak_memory_mb():
+    """Peak memory since the last reset_peak_memory (or process start)"""
+    device = _allocator_device()
+    if device:
+        return tf.config.experimental.get_memory_info(device)["peak"] / 2**20
+    peak = _proc_status_mb("VmHWM")
+    if peak is not None:
+        return peak
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # kB on Linux
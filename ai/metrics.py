@@ -1,3 +1,4 @@
+import numpy as np
 import tensorflow as tf
 
 SMOOTH = 1e-15
@@ -6,10 +7,36 @@ NUM_CLASSES = 6  # background + 5 masks
 CLASS_WEIGHTS = tf.constant([6.5, 7.0, 15.0, 40.0, 10.0, 7.0], dtype=tf.float32)
 NORMALIZED_CLASS_WEIGHTS = CLASS_WEIGHTS / tf.reduce_sum(CLASS_WEIGHTS)
 
+def set_class_weights(weights):
+    """Replace CLASS_WEIGHTS (e.g. with weights derived from the class histogram index)"""
+    global CLASS_WEIGHTS, NORMALIZED_CLASS_WEIGHTS
+    CLASS_WEIGHTS = tf.constant(weights, dtype=tf.float32)
+    NORMALIZED_CLASS_WEIGHTS = CLASS_WEIGHTS / tf.reduce_sum(CLASS_WEIGHTS)
+
+# ---------------- LABELS ----------------
+def _is_one_hot(y_true, num_classes=NUM_CLASSES):
+    # Sparse labels are (..., H, W, 1) or (..., H, W); one-hot labels end in num_classes
+    return y_true.shape.rank is not None and y_true.shape[-1] == num_classes
+
+def class_indices(y_true, num_classes=NUM_CLASSES):
+    """int32 class index map (..., H, W) from sparse (uint8, int or float) or one-hot labels"""
+    if _is_one_hot(y_true, num_classes):
+        return tf.argmax(y_true, axis=-1, output_type=tf.int32)
+    if y_true.shape.rank is not None and y_true.shape[-1] == 1:
+        y_true = tf.squeeze(y_true, axis=-1)
+    # Keras may hand the labels over cast to the prediction dtype
+    return tf.cast(y_true, tf.int32)
+
+def one_hot_labels(y_true, num_classes=NUM_CLASSES, dtype=tf.float32):
+    """One-hot view of the labels, built in the graph when they arrive as class indices"""
+    if _is_one_hot(y_true, num_classes):
+        return tf.cast(y_true, dtype)
+    return tf.one_hot(class_indices(y_true, num_classes), num_classes, dtype=dtype)
+
 # ---------------- PIXEL PRECISION ----------------
 def pixel_precision(y_true, y_pred):
-    y_true_labels = tf.argmax(y_true, axis=-1)
-    y_pred_labels = tf.argmax(y_pred, axis=-1)
+    y_true_labels = class_indices(y_true)
+    y_pred_labels = tf.argmax(y_pred, axis=-1, output_type=tf.int32)
     
     y_true_labels = tf.reshape(y_true_labels, [-1])
     y_pred_labels = tf.reshape(y_pred_labels, [-1])
@@ -21,10 +48,10 @@ def pixel_precision(y_true, y_pred):
 
 # ---------------- PER CLASS PRECISION ----------------
 def per_class_precision(y_true, y_pred):
-    y_true_labels = tf.argmax(y_true, axis=-1)
-    y_pred_labels = tf.argmax(y_pred, axis=-1)
+    y_true_labels = class_indices(y_true)
+    y_pred_labels = tf.argmax(y_pred, axis=-1, output_type=tf.int32)
 
-    num_classes = tf.shape(y_true)[-1]
+    num_classes = NUM_CLASSES
 
     y_true_one_hot = tf.one_hot(y_true_labels, num_classes)
     y_pred_one_hot = tf.one_hot(y_pred_labels, num_classes)
@@ -42,6 +69,7 @@ def per_class_precision(y_true, y_pred):
 
 # ---------------- MULTI-CLASS DICE COEFFICIENT ----------------
 def dice_coef_multi(y_true, y_pred, smooth=SMOOTH):
+    y_true = one_hot_labels(y_true, dtype=y_pred.dtype)
     y_true_f = tf.reshape(y_true, [-1, NUM_CLASSES])
     y_pred_f = tf.reshape(y_pred, [-1, NUM_CLASSES])
 
@@ -58,6 +86,7 @@ def dice_coef_multi(y_true, y_pred, smooth=SMOOTH):
 
 # ---------------- MULTI-CLASS DICE LOSS ----------------
 def dice_loss_multi(y_true, y_pred):
+    y_true = one_hot_labels(y_true, dtype=y_pred.dtype)
     y_true_f = tf.reshape(y_true, [-1, NUM_CLASSES])
     y_pred_f = tf.reshape(y_pred, [-1, NUM_CLASSES])
 
@@ -71,10 +100,18 @@ def dice_loss_multi(y_true, y_pred):
     return 1.0 - tf.reduce_sum(weighted_dice)
 
 # ---------------- COMBINED LOSS ----------------
-def combined_loss(y_true, y_pred):
+FOCAL_GAMMA = 2.0
+FOCAL_EPSILON = 1e-7
+
+def combined_loss_reference(y_true, y_pred):
+    """Unfused focal + dice loss, kept as the reference for combined_loss"""
+    y_pred = tf.cast(y_pred, tf.float32)
+    # Labels may arrive as uint8 class indices, the one-hot view only exists in the graph
+    y_true = one_hot_labels(y_true, dtype=y_pred.dtype)
+
     # Focal Loss Parameters
-    gamma = 2.0
-    epsilon = 1e-7
+    gamma = FOCAL_GAMMA
+    epsilon = FOCAL_EPSILON
     
     # Clip predictions to prevent log(0)
     y_pred = tf.clip_by_value(y_pred, epsilon, 1.0 - epsilon)
@@ -90,3 +127,72 @@ def combined_loss(y_true, y_pred):
 
     d_loss = dice_loss_multi(y_true, y_pred)
     return focal_loss + d_loss
+
+@tf.function(jit_compile=True)
+def _fused_combined_loss(labels, y_pred, class_weights):
+    """Focal + dice loss in one XLA cluster: the one-hot mask, log and power terms
+    are fused into the reductions instead of being materialized per pixel"""
+    y_pred = tf.reshape(y_pred, [-1, NUM_CLASSES])
+    labels = tf.reshape(labels, [-1])
+    y_pred = tf.clip_by_value(y_pred, FOCAL_EPSILON, 1.0 - FOCAL_EPSILON)
+    y_true = tf.one_hot(labels, NUM_CLASSES, dtype=y_pred.dtype)
+    class_weights = tf.cast(class_weights, y_pred.dtype)
+
+    # Only the true class has a non-zero focal term: -w_t * (1 - p_t)^gamma * log(p_t)
+    p_t = tf.reduce_sum(y_true * y_pred, axis=-1)
+    w_t = tf.gather(class_weights, labels)
+    focal_loss = tf.reduce_mean(w_t * tf.math.pow(1.0 - p_t, FOCAL_GAMMA) * -tf.math.log(p_t))
+
+    # Dice from per-class sums over the same clipped predictions
+    intersection = tf.reduce_sum(y_true * y_pred, axis=0)
+    denominator = tf.reduce_sum(y_true, axis=0) + tf.reduce_sum(y_pred, axis=0)
+    dice_per_class = (2.0 * intersection + SMOOTH) / (denominator + SMOOTH)
+    d_loss = 1.0 - tf.reduce_sum(dice_per_class * class_weights / tf.reduce_sum(class_weights))
+    return focal_loss + d_loss
+
+def combined_loss(y_true, y_pred):
+    """Weighted focal loss + weighted dice loss (fused, see combined_loss_reference)"""
+    # Always computed in float32, also under a mixed precision policy
+    return _fused_combined_loss(class_indices(y_true), tf.cast(y_pred, tf.float32), CLASS_WEIGHTS)
+
+# ---------------- CONFUSION MATRIX SCORES (NUMPY) ----------------
+def confusion_matrices(gt, pred, num_classes=NUM_CLASSES):
+    """Confusion matrix (rows: GT, cols: pred) from a single bincount over gt * C + pred.
+    gt/pred of shape [H, W] give [C, C]; a batch [B, H, W] gives [B, C, C]."""
+    gt = np.asarray(gt, dtype=np.int64)
+    pred = np.asarray(pred, dtype=np.int64)
+    batched = gt.ndim == 3
+    if not batched:
+        gt, pred = gt[np.newaxis], pred[np.newaxis]
+    batch = gt.shape[0]
+
+    # Offset every image into its own C*C block so one bincount covers the batch
+    offsets = np.arange(batch, dtype=np.int64)[:, np.newaxis] * num_classes * num_classes
+    codes = offsets + gt.reshape(batch, -1) * num_classes + pred.reshape(batch, -1)
+    cm = np.bincount(codes.ravel(), minlength=batch * num_classes * num_classes)
+    cm = cm.reshape(batch, num_classes, num_classes)
+    return cm if batched else cm[0]
+
+def scores_from_confusion(cm):
+    """Macro F1, Jaccard, recall and precision over the classes present in the GT.
+    Matches sklearn's average='macro', labels=<present GT classes>, zero_division=0.
+    cm of shape [C, C] gives [4]; [B, C, C] gives [B, 4]."""
+    cm = np.asarray(cm, dtype=np.float64)
+    tp = np.diagonal(cm, axis1=-2, axis2=-1)
+    gt_count = cm.sum(axis=-1)
+    pred_count = cm.sum(axis=-2)
+    fp = pred_count - tp
+    fn = gt_count - tp
+
+    def _ratio(num, den):
+        return np.divide(num, den, out=np.zeros_like(num), where=den > 0)
+
+    f1 = _ratio(2.0 * tp, 2.0 * tp + fp + fn)
+    jaccard = _ratio(tp, tp + fp + fn)
+    recall = _ratio(tp, gt_count)
+    precision = _ratio(tp, pred_count)
+
+    present = gt_count > 0
+    num_present = np.maximum(present.sum(axis=-1), 1)
+    per_class = np.stack([f1, jaccard, recall, precision], axis=-2)  # [..., 4, C]
+    return np.where(present[..., np.newaxis, :], per_class, 0.0).sum(axis=-1) / num_present[..., np.newaxis]
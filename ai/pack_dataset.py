@@ -0,0 +1,67 @@
+import os
+import json
+import argparse
+import numpy as np
+import cv2
+from tqdm import tqdm
+
+from train import H, W, load_dataset, read_mask, PACKED_DIR, PACKED_MANIFEST
+
+# ---------------- PATHS ----------------
+POST_ROOT = "./post_dataset_taco"
+
+def pack_dataset(path, split=0.2):
+    """Write images (N x H x W x 3) and masks (N x H x W) as uint8 memory-mapped arrays"""
+    (train_x, train_y), (valid_x, valid_y), (test_x, test_y) = load_dataset(path, split)
+    images = train_x + valid_x + test_x
+    masks = train_y + valid_y + test_y
+
+    out_dir = os.path.join(path, PACKED_DIR)
+    os.makedirs(out_dir, exist_ok=True)
+
+    # Keep the on-disk order sorted by name so shards are reproducible
+    order = sorted(range(len(images)), key=lambda i: images[i])
+    position = {original: packed for packed, original in enumerate(order)}
+
+    image_shard = np.lib.format.open_memmap(
+        os.path.join(out_dir, "images.npy"), mode="w+", dtype=np.uint8, shape=(len(images), H, W, 3)
+    )
+    mask_shard = np.lib.format.open_memmap(
+        os.path.join(out_dir, "masks.npy"), mode="w+", dtype=np.uint8, shape=(len(masks), H, W)
+    )
+
+    for packed, original in enumerate(tqdm(order)):
+        image = cv2.imread(images[original], cv2.IMREAD_COLOR)
+        image_shard[packed] = cv2.resize(image, (W, H))
+        mask_shard[packed] = read_mask(masks[original])[:, :, 0]
+
+    image_shard.flush()
+    mask_shard.flush()
+
+    # Split lists keep the exact order load_dataset returns them in
+    offsets = np.cumsum([0, len(train_x), len(valid_x)])
+    splits = {
+        name: [position[i] for i in range(start, start + size)]
+        for name, start, size in zip(["train", "valid", "test"], offsets, [len(train_x), len(valid_x), len(test_x)])
+    }
+    manifest = {
+        "height": H,
+        "width": W,
+        "split_ratio": split,
+        "names": [os.path.splitext(os.path.basename(images[i]))[0] for i in order],
+        "splits": splits,
+    }
+    # Written last, so an interrupted run never leaves a usable-looking manifest
+    with open(os.path.join(out_dir, PACKED_MANIFEST), "w") as f:
+        json.dump(manifest, f)
+
+    print(f"Packed {len(images)} samples into {out_dir} "
+          f"(train: {len(train_x)}, valid: {len(valid_x)}, test: {len(test_x)})")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack a preprocessed dataset into memory-mapped uint8 arrays")
+    parser.add_argument("--path", default=POST_ROOT, help="dataset folder containing images/ and masks/")
+    parser.add_argument("--split", type=float, default=0.2, help="validation/test split ratio (as in load_dataset)")
+    args = parser.parse_args()
+
+    pack_dataset(args.path, args.split)
@@ -1,9 +1,15 @@
 import os
 import json
+import time
+import argparse
+import multiprocessing
 import cv2
 import numpy as np
 from tqdm import tqdm
 
+from class_histogram import mask_histogram, record_class_histograms
+from image_decode import reduced_read_flag
+
 # ---------------- PATHS ----------------
 TACO_DATA = "./data_taco"
 ANNOT_PATH = os.path.join(TACO_DATA, "annotations.json")
@@ -11,22 +17,10 @@ IMG_ROOT = TACO_DATA
 
 POST_ROOT = "./post_dataset_taco"
 IMG_OUT = os.path.join(POST_ROOT, "images")
-MASK_OUT = os.path.join(POST_ROOT, "masks")
-
-os.makedirs(IMG_OUT, exist_ok=True)
-os.makedirs(MASK_OUT, exist_ok=True)
-
-# ---------------- LOAD COCO ----------------
-with open(ANNOT_PATH, "r") as f:
-    taco = json.load(f)
-
-images_info = {img["id"]: img for img in taco["images"]}
-annotations = taco["annotations"]
-categories = taco["categories"]
-
-print(f"Images: {len(images_info)}")
-print(f"Annotations: {len(annotations)}")
-print(f"Categories: {len(categories)}")
+MASK_OUT = os.path.join(POST_ROOT, "masks")              # single-channel class-index masks
+MASK_COLOR_OUT = os.path.join(POST_ROOT, "masks_color")  # optional BGR masks for visualization
+# One JSON line per finished image, so an interrupted run can resume
+DONE_MANIFEST = os.path.join(POST_ROOT, "preprocess_done.jsonl")
 
 # ---------------- CATEGORY → RECYCLING ----------------
 category_to_recycling = {
@@ -112,30 +106,37 @@ RECYCLING_COLORS = {
     "other": (0, 0, 255),    # red
 }
 
-# Map category id → recycling index
-cat_id_to_recycling_idx = {
-    cat["id"]: recycling_to_index[category_to_recycling[cat["name"]]]
-    for cat in categories
-}
+# ---------------- PROCESS ONE IMAGE ----------------
+# Set once per process (see init_worker), so tasks only carry the image and its annotations
+cat_id_to_recycling_idx = None
+save_color_masks = False
+reduced_decode = True
 
-# ---------------- GROUP ANNOTATIONS BY IMAGE ----------------
-anns_by_image = {}
-for ann in annotations:
-    anns_by_image.setdefault(ann["image_id"], []).append(ann)
+def init_worker(cat_map, color_masks, reduced=True):
+    global cat_id_to_recycling_idx, save_color_masks, reduced_decode
+    cat_id_to_recycling_idx = cat_map
+    save_color_masks = color_masks
+    reduced_decode = reduced
+    # Parallelism comes from the process pool
+    cv2.setNumThreads(1)
 
-# ---------------- PROCESS IMAGES ----------------
-for img_id, img_info in tqdm(images_info.items()):
+def process_image(task):
+    """Write the 256x256 image and class-index mask, return (img_id, name, class histogram)"""
+    img_id, img_info, anns = task
     file_name = img_info["file_name"]
     img_path = os.path.join(IMG_ROOT, file_name)
 
     if not os.path.exists(img_path):
         print("Missing:", img_path)
-        continue
+        return img_id, None, None
 
-    # Read & resize image
-    image = cv2.imread(img_path)
+    # Read & resize image (polygons are scaled from the annotation size, not the decoded size)
+    flag = cv2.IMREAD_COLOR
+    if reduced_decode:
+        _, flag = reduced_read_flag(file_name, img_info["width"], img_info["height"])
+    image = cv2.imread(img_path, flag)
     if image is None:
-        continue
+        return img_id, None, None
     image = cv2.resize(image, (256, 256))
     h, w = image.shape[:2]
 
@@ -143,7 +144,7 @@ for img_id, img_info in tqdm(images_info.items()):
     mask = np.zeros((256, 256), dtype=np.uint8)
 
     # Process annotations for this image
-    for ann in anns_by_image.get(img_id, []):
+    for ann in anns:
         cat_id = ann["category_id"]
         recycling_idx = cat_id_to_recycling_idx[cat_id]
 
@@ -161,11 +162,122 @@ for img_id, img_info in tqdm(images_info.items()):
     #tqdm.write(f"Name : {name_noext}")
     cv2.imwrite(os.path.join(IMG_OUT, name_noext + ".png"), image)
 
-    # Convert mask to BGR for visualization
-    mask_bgr = np.zeros((256, 256, 3), dtype=np.uint8)
-    for r_type, color in RECYCLING_COLORS.items():
-        mask_bgr[mask == recycling_to_index[r_type]] = color
-    
-    cv2.imwrite(os.path.join(MASK_OUT, name_noext + ".png"), mask_bgr)
+    # Pixel values are the recycling indices, read back directly by train.py / test.py
+    cv2.imwrite(os.path.join(MASK_OUT, name_noext + ".png"), mask)
+
+    if save_color_masks:
+        # Convert mask to BGR for visualization
+        mask_bgr = np.zeros((256, 256, 3), dtype=np.uint8)
+        for r_type, color in RECYCLING_COLORS.items():
+            mask_bgr[mask == recycling_to_index[r_type]] = color
+
+        cv2.imwrite(os.path.join(MASK_COLOR_OUT, name_noext + ".png"), mask_bgr)
+
+    return img_id, name_noext, mask_histogram(mask)
+
+def read_done_manifest():
+    """Images finished by a previous (possibly interrupted) run: {img_id: (name, histogram)}"""
+    done = {}
+    if not os.path.exists(DONE_MANIFEST):
+        return done
+    with open(DONE_MANIFEST, "r") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # line cut short by the interruption
+            done[entry["id"]] = (entry["name"], entry["histogram"])
+    return done
+
+# ---------------- MAIN ----------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert TACO annotations into 256x256 images and class-index masks")
+    parser.add_argument("--color-masks", action="store_true",
+                        help=f"also write BGR visualization masks to {MASK_COLOR_OUT}")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes (1 = serial)")
+    parser.add_argument("--chunksize", type=int, default=8,
+                        help="images handed to a worker at a time")
+    parser.add_argument("--full-decode", action="store_true",
+                        help="decode JPEGs at full resolution instead of the smallest DCT-scaled size covering 256x256")
+    parser.add_argument("--restart", action="store_true",
+                        help=f"ignore {DONE_MANIFEST} and process every image again")
+    args = parser.parse_args()
+
+    os.makedirs(IMG_OUT, exist_ok=True)
+    os.makedirs(MASK_OUT, exist_ok=True)
+    if args.color_masks:
+        os.makedirs(MASK_COLOR_OUT, exist_ok=True)
+
+    # ---------------- LOAD COCO ----------------
+    with open(ANNOT_PATH, "r") as f:
+        taco = json.load(f)
+
+    images_info = {img["id"]: img for img in taco["images"]}
+    annotations = taco["annotations"]
+    categories = taco["categories"]
+
+    print(f"Images: {len(images_info)}")
+    print(f"Annotations: {len(annotations)}")
+    print(f"Categories: {len(categories)}")
+
+    # Map category id → recycling index
+    cat_map = {
+        cat["id"]: recycling_to_index[category_to_recycling[cat["name"]]]
+        for cat in categories
+    }
+
+    # ---------------- GROUP ANNOTATIONS BY IMAGE ----------------
+    anns_by_image = {}
+    for ann in annotations:
+        anns_by_image.setdefault(ann["image_id"], []).append(ann)
+
+    # ---------------- RESUME ----------------
+    if args.restart and os.path.exists(DONE_MANIFEST):
+        os.remove(DONE_MANIFEST)
+    done = read_done_manifest()
+    tasks = [
+        (img_id, img_info, anns_by_image.get(img_id, []))
+        for img_id, img_info in images_info.items()
+        if img_id not in done
+    ]
+    if done:
+        print(f"Resuming: {len(done)} images already done, {len(tasks)} left")
+
+    # ---------------- PROCESS IMAGES ----------------
+    start = time.time()
+    with open(DONE_MANIFEST, "a+") as manifest:
+        # Terminate a line cut short by an interruption
+        if manifest.tell() > 0:
+            manifest.seek(manifest.tell() - 1)
+            if manifest.read(1) != "\n":
+                manifest.write("\n")
+        if args.workers > 1:
+            pool = multiprocessing.Pool(args.workers, initializer=init_worker, initargs=(cat_map, args.color_masks, not args.full_decode))
+            results = pool.imap_unordered(process_image, tasks, chunksize=args.chunksize)
+        else:
+            pool = None
+            init_worker(cat_map, args.color_masks, not args.full_decode)
+            results = map(process_image, tasks)
+
+        processed = 0
+        for img_id, name, histogram in tqdm(results, total=len(tasks)):
+            if name is None:
+                continue  # missing or unreadable, retried on the next run
+            processed += 1
+            done[img_id] = (name, histogram.tolist())
+            manifest.write(json.dumps({"id": img_id, "name": name, "histogram": done[img_id][1]}) + "\n")
+            manifest.flush()
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+    elapsed = time.time() - start
+
+    # Per-image class pixel counts, used by train.py for sampling and class weights
+    histograms = {name: np.array(histogram) for name, histogram in done.values()}
+    record_class_histograms(POST_ROOT, histograms)
 
-print("Done!")
+    print(f"Processed {processed} images in {elapsed:.1f}s "
+          f"({processed / max(elapsed, 1e-9):.2f} images/sec, {args.workers} worker(s))")
+    print("Done!")
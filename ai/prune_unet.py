@@ -0,0 +1,238 @@
+import os
+import copy
+import json
+import argparse
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+import yaml
+from tqdm import tqdm
+from tensorflow.keras.layers import Conv2D, SeparableConv2D, Conv2DTranspose, GroupNormalization, Activation, Concatenate, InputLayer
+
+from train import H, W, PACKED_DIR, NUM_CLASSES, SEED, load_dataset, load_packed_dataset, tf_dataset, compile_model
+from image_proccessing import init_transform
+from unet import build_unet, unet_filters, round_filters, model_cost, print_model_cost, ConvBlock
+from inference_backends import load_keras_model
+
+# ---------------- PARAMETERS ----------------
+CRITERIA = ["l1", "activation"]
+DATASET_PATH = "./post_dataset_taco"
+
+def read_config(file_path):
+    with open(file_path, 'r') as file:
+        try:
+            return yaml.safe_load(file)
+        except yaml.YAMLError as exc:
+            print(f"Error reading YAML file: {exc}")
+            return None
+
+# ---------------- GRAPH ----------------
+def _inbound(layer):
+    inputs = layer.input if isinstance(layer.input, list) else [layer.input]
+    return [t._keras_history.layer for t in inputs]
+
+def _consumers(model):
+    consumers = {layer.name: [] for layer in model.layers}
+    for layer in model.layers:
+        if not isinstance(layer, InputLayer):
+            for inbound in _inbound(layer):
+                consumers[inbound.name].append(layer)
+    return consumers
+
+def prunable_layers(model):
+    """Convolutions whose output channels can be removed: every conv_block conv and the
+    decoder upsampling, not the softmax head"""
+    head = model.layers[-1]
+    return [layer for layer in model.layers
+            if isinstance(layer, (Conv2D, SeparableConv2D)) and layer is not head]
+
+def check_prunable(model, config_params):
+    if config_params.get("encoder", "plain") != "plain":
+        raise ValueError("Pruning supports the plain U-Net only, not pretrained encoders")
+    if any(isinstance(layer, ConvBlock) for layer in model.layers):
+        raise ValueError("Pruning needs the unfused conv blocks, train the model with remat: false")
+
+# ---------------- RANKING ----------------
+def l1_scores(layer):
+    """L1 norm of each output filter"""
+    if isinstance(layer, SeparableConv2D):
+        return np.abs(layer.pointwise_kernel.numpy()).sum(axis=(0, 1, 2))
+    if isinstance(layer, Conv2DTranspose):
+        return np.abs(layer.kernel.numpy()).sum(axis=(0, 1, 3))  # kernel is (h, w, out, in)
+    return np.abs(layer.kernel.numpy()).sum(axis=(0, 1, 2))
+
+def activation_scores(model, layers, dataset, num_batches):
+    """Mean |activation| of each output channel on training images. Conv block channels are
+    measured after GroupNorm + ReLU, which is what the next layer actually sees."""
+    consumers = _consumers(model)
+    probes = []
+    for layer in layers:
+        probe = layer
+        nxt = consumers[probe.name]
+        if len(nxt) == 1 and isinstance(nxt[0], GroupNormalization):
+            probe = nxt[0]
+            nxt = consumers[probe.name]
+            if len(nxt) == 1 and isinstance(nxt[0], Activation):
+                probe = nxt[0]
+        probes.append(probe.output)
+    probe_model = tf.keras.Model(model.inputs, probes)
+
+    @tf.function
+    def channel_means(x):
+        return [tf.reduce_mean(tf.abs(p), axis=[0, 1, 2]) for p in probe_model(x, training=False)]
+
+    totals = [np.zeros(p.shape[-1]) for p in probes]
+    count = 0
+    for x, _ in tqdm(dataset.take(num_batches), total=num_batches, desc="Activation statistics"):
+        for total, mean in zip(totals, channel_means(x)):
+            total += mean.numpy()
+        count += 1
+    return [total / max(count, 1) for total in totals]
+
+# ---------------- PRUNING ----------------
+def pruned_filters(filters, ratio, levels):
+    """Filters per level after keeping `ratio` of the channels of the chosen levels"""
+    return [round_filters(f * ratio) if i in levels else f for i, f in enumerate(filters)]
+
+def _slice(layer, weights, in_idx, out_idx):
+    if isinstance(layer, SeparableConv2D):
+        depthwise, pointwise, *bias = weights
+        return [depthwise[:, :, in_idx], pointwise[:, :, in_idx][..., out_idx]] + [b[out_idx] for b in bias]
+    if isinstance(layer, Conv2DTranspose):
+        kernel, *bias = weights
+        return [kernel[:, :, out_idx][..., in_idx]] + [b[out_idx] for b in bias]
+    if isinstance(layer, Conv2D):
+        kernel, *bias = weights
+        return [kernel[:, :, in_idx][..., out_idx]] + [b[out_idx] for b in bias]
+    if isinstance(layer, GroupNormalization):
+        return [w[out_idx] for w in weights]
+    return weights
+
+def prune(model, config_params, new_filters, scores):
+    """Smaller U-Net (new_filters) holding the highest scoring channels of `model`.
+    scores maps each prunable layer name to one score per output channel."""
+    config = dict(config_params, filters=new_filters, num_classes=NUM_CLASSES)
+    pruned = build_unet((H, W, 3), config)
+    if len(pruned.layers) != len(model.layers):
+        raise ValueError("Rebuilt model does not match the original layer structure")
+
+    # Original channel indices carried by each layer output
+    kept = {}
+    for old, new in zip(model.layers, pruned.layers):
+        if type(old) is not type(new):
+            raise ValueError(f"Layer mismatch: {old.name} ({type(old).__name__}) vs {new.name} ({type(new).__name__})")
+        if isinstance(old, InputLayer):
+            kept[old.name] = np.arange(old.output.shape[-1])
+            continue
+
+        inbound = _inbound(old)
+        if isinstance(old, Concatenate):
+            offsets = np.cumsum([0] + [layer.output.shape[-1] for layer in inbound[:-1]])
+            kept[old.name] = np.concatenate([kept[layer.name] + o for layer, o in zip(inbound, offsets)])
+            continue
+
+        in_idx = kept[inbound[0].name]
+        if old.name in scores:
+            # Top channels by score, in their original order
+            out_idx = np.sort(np.argsort(scores[old.name])[::-1][:new.filters])
+        elif isinstance(old, (Conv2D, SeparableConv2D)):
+            out_idx = np.arange(old.filters)  # softmax head
+        else:
+            out_idx = in_idx  # GroupNorm, activations, pooling keep their input channels
+        kept[old.name] = out_idx
+        new.set_weights(_slice(old, old.get_weights(), in_idx, out_idx))
+    return pruned
+
+# ---------------- EVALUATION ----------------
+def evaluate(model, valid_dataset, latency_runs):
+    cost = model_cost(model, latency_runs)
+    print_model_cost(cost)
+    dice = model.evaluate(valid_dataset, verbose=0, return_dict=True)["dice"]
+    print(f"Validation Dice: {dice:.4f}")
+    return {**cost, "dice": float(dice)}
+
+def save_step(model, config_params, name, filters):
+    """Save as results/<name>/<name>.h5 with its config, so test.py and the converters take it as is"""
+    os.makedirs(os.path.join("results", name), exist_ok=True)
+    model.save(os.path.join("results", name, f"{name}.h5"))
+    config = copy.deepcopy(config_params)
+    config.update({"name": name, "filters": [int(f) for f in filters]})
+    with open(os.path.join("results", name, "config.yaml"), "w") as f:
+        yaml.safe_dump(config, f, sort_keys=False)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Iterative structured channel pruning of a trained U-Net")
+    parser.add_argument("config", help="YAML config of the model (results/<name>/<name>.h5)")
+    parser.add_argument("--criterion", choices=CRITERIA, default="l1",
+                        help="rank channels by filter L1 norm or by mean activation on training images")
+    parser.add_argument("--ratio", type=float, default=0.75, help="fraction of channels kept per step")
+    parser.add_argument("--steps", type=int, default=3)
+    parser.add_argument("--levels", type=int, nargs="+", default=None,
+                        help="levels to prune, 0 = first encoder level, last = bridge (default: all)")
+    parser.add_argument("--epochs", type=int, default=2, help="fine-tuning epochs after each step")
+    parser.add_argument("--lr", type=float, default=1e-4)
+    parser.add_argument("--batch-size", type=int, default=None, help="default: batch_size from the config")
+    parser.add_argument("--stat-batches", type=int, default=20, help="batches for the activation statistics")
+    parser.add_argument("--latency-runs", type=int, default=10)
+    args = parser.parse_args()
+
+    np.random.seed(SEED)
+    tf.random.set_seed(SEED)
+
+    config_params = read_config(args.config)
+    if config_params is None:
+        raise Exception("Could not read the config file!")
+    init_transform(config_params)
+    model_name = config_params["name"]
+    optimizer = config_params.get("optimizer", "Adam")
+    batch_size = args.batch_size or int(config_params.get("batch_size", 2))
+
+    if config_params.get("packed", False):
+        (train_x, train_y), (valid_x, valid_y), _ = load_packed_dataset(os.path.join(DATASET_PATH, PACKED_DIR))
+    else:
+        (train_x, train_y), (valid_x, valid_y), _ = load_dataset(DATASET_PATH)
+    train_dataset = tf_dataset(train_x, train_y, batch=batch_size, use_augmentation=True)
+    valid_dataset = tf_dataset(valid_x, valid_y, batch=batch_size, use_augmentation=False)
+    stat_dataset = tf_dataset(train_x, train_y, batch=batch_size, use_augmentation=False)
+
+    model = load_keras_model(os.path.join("results", model_name, f"{model_name}.h5"), compile=False)
+    check_prunable(model, config_params)
+    filters = unet_filters(config_params)
+    levels = set(range(len(filters)) if args.levels is None else args.levels)
+
+    print(f"\n--- Step 0: {model_name}, filters {filters} ---")
+    compile_model(model, optimizer, args.lr, "float32", False)
+    report = [{"step": 0, "name": model_name, "filters": filters, **evaluate(model, valid_dataset, args.latency_runs)}]
+
+    for step in range(1, args.steps + 1):
+        new_filters = pruned_filters(filters, args.ratio, levels)
+        if new_filters == filters:
+            print("Nothing left to prune at this ratio")
+            break
+        name = f"{model_name}_p{step}"
+        print(f"\n--- Step {step}: {name}, filters {new_filters} ({args.criterion}) ---")
+
+        layers = prunable_layers(model)
+        if args.criterion == "activation":
+            values = activation_scores(model, layers, stat_dataset, args.stat_batches)
+        else:
+            values = [l1_scores(layer) for layer in layers]
+        model = prune(model, config_params, new_filters, dict(zip([layer.name for layer in layers], values)))
+        filters = new_filters
+
+        compile_model(model, optimizer, args.lr, "float32", False)
+        dice_before = model.evaluate(valid_dataset, verbose=0, return_dict=True)["dice"]
+        print(f"Validation Dice right after pruning: {dice_before:.4f}")
+        model.fit(train_dataset, epochs=args.epochs, validation_data=valid_dataset, verbose=2)
+
+        save_step(model, config_params, name, filters)
+        report.append({"step": step, "name": name, "filters": filters, "dice_before_finetune": float(dice_before),
+                       **evaluate(model, valid_dataset, args.latency_runs)})
+
+    # ---------------- REPORT ----------------
+    print(f"\n--- Pruning report ({args.criterion}, ratio {args.ratio}) ---")
+    df = pd.DataFrame(report)
+    print(df[["step", "name", "params", "gflops", "latency_ms", "dice"]].to_string(index=False))
+    df.to_csv(os.path.join("results", model_name, "pruning_report.csv"), index=False)
+    with open(os.path.join("results", model_name, "pruning_report.json"), "w") as f:
+        json.dump(report, f, indent=2)
@@ -0,0 +1,59 @@
+import tensorflow as tf
+
+# Layers that get fake-quant nodes during quantization-aware training. GroupNormalization
+# has no int8 kernel in TFLite, it (and anything else not listed) stays float in both
+# the fine-tuning graph and the exported model.
+QUANTIZED_LAYERS = (
+    tf.keras.layers.Conv2D,  # also covers Conv2DTranspose
+    tf.keras.layers.SeparableConv2D,
+    tf.keras.layers.DepthwiseConv2D,
+    tf.keras.layers.Activation,
+    tf.keras.layers.ReLU,
+    tf.keras.layers.MaxPooling2D,
+    tf.keras.layers.Concatenate,
+)
+
+def _tfmot():
+    try:
+        import tensorflow_model_optimization as tfmot
+    except ImportError:
+        raise Exception("quantization_aware needs tensorflow-model-optimization (pip install tensorflow-model-optimization)")
+    return tfmot
+
+def quantize_scope():
+    """Custom objects needed to load a model saved during quantization-aware training"""
+    return _tfmot().quantization.keras.quantize_scope()
+
+def quantize_aware_model(model):
+    """Copy of a trained float model with fake-quant nodes on QUANTIZED_LAYERS, weights kept"""
+    tfmot = _tfmot()
+    if any(isinstance(layer, tf.keras.Model) for layer in model.layers):
+        raise ValueError("Quantization-aware training does not support pretrained encoder models, "
+                         "use post-training int8 (convert_model.py --mode int8) instead")
+
+    def annotate(layer):
+        if isinstance(layer, QUANTIZED_LAYERS):
+            return tfmot.quantization.keras.quantize_annotate_layer(layer)
+        return layer
+
+    annotated = tf.keras.models.clone_model(model, clone_function=annotate)
+    annotated.set_weights(model.get_weights())
+    quantized = tfmot.quantization.keras.quantize_apply(annotated)
+
+    num_quantized = sum(isinstance(layer.layer, QUANTIZED_LAYERS) for layer in quantized.layers
+                        if isinstance(layer, tfmot.quantization.keras.QuantizeWrapper))
+    print(f"Quantization-aware model: {num_quantized} quantized layers, the rest stays float")
+    return quantized
+
+def export_int8_tflite(model, path):
+    """int8 TFLite model from a quantization-aware Keras model. The fake-quant ranges learned
+    during fine-tuning are used, so no calibration data is needed. Same static batch-1
+    float32 input/output as convert_model.py, so Classifier.cs feeds it unchanged."""
+    input_spec = tf.TensorSpec([1] + list(model.input.shape[1:]), tf.float32)
+    concrete = tf.function(lambda x: model(x, training=False)).get_concrete_function(input_spec)
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([concrete], model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    tflite_model = converter.convert()
+    with open(path, "wb") as f:
+        f.write(tflite_model)
+    return len(tflite_model)
@@ -6,19 +6,29 @@ import cv2
 import pandas as pd
 from tqdm import tqdm
 import tensorflow as tf
-from tensorflow.keras.utils import CustomObjectScope
-from sklearn.metrics import f1_score, jaccard_score, precision_score, recall_score, confusion_matrix
 import yaml
-import sys
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 
-from train import load_dataset
-from metrics import dice_coef_multi, combined_loss, pixel_precision, per_class_precision
-from DicePerClass import DicePerClassMetric
+from train import load_dataset, read_mask as read_class_mask
+from metrics import confusion_matrices, scores_from_confusion
+from inference_backends import BACKENDS, TFLitePredictor, default_artifact, load_predictor
 """ ---------------- GLOBAL PARAMETERS ---------------- """
 H = 256
 W = 256
 SEED = 42
-CONFIG_FILE_PATH = sys.argv[1]
+
+parser = argparse.ArgumentParser(description="Evaluate a trained model on the test split")
+parser.add_argument("config", help="YAML config of the model (results/<name>/<name>.h5)")
+parser.add_argument("--batch-size", type=int, default=None,
+                    help="images per inference batch (default: test_batch_size from the config, else 8)")
+parser.add_argument("--backend", choices=BACKENDS, default="keras",
+                    help="score the exported artifact instead of the Keras model")
+parser.add_argument("--artifact", default=None,
+                    help="model file for the backend (default: results/<name>/<name>.h5/.onnx/.tflite)")
+parser.add_argument("--threads", type=int, default=None, help="onnxruntime/TFLite CPU threads")
+args = parser.parse_args()
+CONFIG_FILE_PATH = args.config
 
 # ---------------- MASK COLORS ----------------
 # CLASS_COLORS = [
@@ -48,9 +58,11 @@ def create_dir(path):
     if not os.path.exists(path):
         os.makedirs(path)
 
-def write_results_to_file(score, file_path):
+def write_results_to_file(score, file_path, title=None, mode='w'):
     try:
-        with open(file_path, 'w') as file:
+        with open(file_path, mode) as file:
+            if title is not None:
+                file.write(f"\n{title}\n")
             file.write(f"F1: {score[0]:0.5f}\n")
             file.write(f"Jaccard: {score[1]:0.5f}\n")
             file.write(f"Recall: {score[2]:0.5f}\n")
@@ -60,19 +72,6 @@ def write_results_to_file(score, file_path):
         print(f"An error occurred: {e}")
 
 # ---------------- MASK HANDLING ----------------
-def read_mask(path):
-    """Read a color mask and convert to one-hot and class indices"""
-    mask = cv2.imread(path, cv2.IMREAD_COLOR)
-    mask = cv2.resize(mask, (W, H), interpolation=cv2.INTER_NEAREST)
-    
-    # Robust matching using Euclidean distance
-    diff = mask[:, :, np.newaxis, :] - np.array(CLASS_COLORS)[np.newaxis, np.newaxis, :, :]
-    dist = np.sum(np.square(diff), axis=-1)
-    class_mask = np.argmin(dist, axis=-1).astype(np.uint8)
-
-    one_hot = np.eye(NUM_CLASSES)[class_mask]
-    return one_hot.astype(np.float32), class_mask, mask
-
 def colorize_mask(mask_class_indices):
     """Colorize the mask indices for visualization"""
     mask_class_indices = mask_class_indices.astype(np.uint8)
@@ -81,6 +80,24 @@ def colorize_mask(mask_class_indices):
         color_mask[mask_class_indices == idx] = color
     return color_mask
 
+def load_test_sample(x_path, y_path):
+    """Resized uint8 image and class-index mask of one test sample"""
+    image = cv2.imread(x_path.decode(), cv2.IMREAD_COLOR)
+    image_resized = cv2.resize(image, (W, H))
+    mask_class = read_class_mask(y_path)[:, :, 0]
+    return image_resized, mask_class
+
+def test_dataset(X, Y, batch):
+    """Decode in parallel, batch and prefetch the test split (order is preserved)"""
+    dataset = tf.data.Dataset.from_tensor_slices((X, Y))
+    dataset = dataset.map(
+        lambda x, y: tf.numpy_function(load_test_sample, [x, y], [tf.uint8, tf.uint8]),
+        num_parallel_calls=tf.data.AUTOTUNE
+    )
+    dataset = dataset.batch(batch)
+    dataset = dataset.prefetch(tf.data.AUTOTUNE)
+    return dataset
+
 def save_results(image, mask_image, pred_class, save_image_path):
     """Save a two-panel image: left = GT mask, right = prediction mask"""
     left = cv2.addWeighted(image, 0.5, mask_image, 0.9, 0)
@@ -104,17 +121,12 @@ tf.random.set_seed(SEED)
 # ---------------- LOAD MODEL ----------------
 create_dir("results")
 model_name = config_params["name"]
-model_file_path = os.path.join("results", model_name, f"{model_name}.h5")
-print(f"Using model: {model_file_path}")
-
-with CustomObjectScope({
-    "combined_loss": combined_loss,
-    "dice_coef_multi": dice_coef_multi,
-    "pixel_precision": pixel_precision,
-    "per_class_precision": per_class_precision,
-}):
-    model = tf.keras.models.load_model(model_file_path)
-    
+model_file_path = args.artifact or default_artifact(model_name, args.backend)
+print(f"Using model: {model_file_path} ({args.backend})")
+
+predictor = load_predictor(args.backend, model_file_path, args.threads)
+# Keras results keep their names, other backends get their own files next to them
+suffix = "" if args.backend == "keras" else f"_{args.backend}"
 
 print("Model loaded!")
 
@@ -127,56 +139,76 @@ dataset_path = "./post_dataset_taco"
 
 
 # ---------------- PREDICTION & METRICS ----------------
-SCORE = []
-save_dir = os.path.join("results", model_name, "images")
-checkIfFolderExists(save_dir)
-total_cm = np.zeros((NUM_CLASSES, NUM_CLASSES))
+batch_size = args.batch_size or int(config_params.get("test_batch_size", 8))
 
-for x_path, y_path in tqdm(zip(test_x, test_y), total=len(test_y)):
-    name = os.path.basename(x_path)
+def score_batch(names, images, masks, preds):
+    """Save overlays and compute per-image metrics for one batch (runs beside inference)"""
+    # One confusion matrix per image, every metric is derived from it
+    cms = confusion_matrices(masks, preds, NUM_CLASSES)
+    scores = scores_from_confusion(cms)
 
-    # Read image
-    image = cv2.imread(x_path, cv2.IMREAD_COLOR)
-    image_resized = cv2.resize(image, (W, H))
-    x_input = np.expand_dims(image_resized / 255.0, axis=0)
-
-    # Read mask
-    mask_onehot, mask_class, mask_image = read_mask(y_path)
-
-    # Predict
-    y_pred = model.predict(x_input, verbose=0)[0]  # [H, W, num_classes]
-
-    pred_class = np.argmax(y_pred, axis=-1)
+    rows = []
+    for name, image_resized, mask_class, pred_class, cm, score in zip(names, images, masks, preds, cms, scores):
+        mask_image = colorize_mask(mask_class)
 
-    unique_gt = np.unique(mask_class)
-    unique_pred = np.unique(pred_class)
-    tqdm.write(f"Image: {name} | GT Classes: {unique_gt} | Pred Classes: {unique_pred}")
+        unique_gt = np.flatnonzero(cm.sum(axis=1))
+        unique_pred = np.flatnonzero(cm.sum(axis=0))
+        tqdm.write(f"Image: {name} | GT Classes: {unique_gt} | Pred Classes: {unique_pred}")
 
-    # Save overlay results
-    save_image_path = os.path.join(save_dir, name)
-    save_results(image_resized, mask_image, pred_class, save_image_path)
+        # Save overlay results
+        save_image_path = os.path.join(save_dir, name)
+        save_results(image_resized, mask_image, pred_class, save_image_path)
 
-    # Flatten for metrics
-    mask_flat = mask_class.flatten()
-    pred_flat = pred_class.flatten()
-    valid_labels = np.unique(mask_flat)  # compute metrics only for present classes
+        # F1, Jaccard, Recall, Precision over the classes present in the GT
+        rows.append([name, *score])
+    return rows, cms.sum(axis=0)
 
-    f1_value = f1_score(mask_flat, pred_flat, average='macro', labels=valid_labels, zero_division=0)
-    jac_value = jaccard_score(mask_flat, pred_flat, average='macro', labels=valid_labels, zero_division=0)
-    recall_value = recall_score(mask_flat, pred_flat, average='macro', labels=valid_labels, zero_division=0)
-    precision_value = precision_score(mask_flat, pred_flat, average='macro', labels=valid_labels, zero_division=0)
-
-    # Update Confusion Matrix
-    total_cm += confusion_matrix(mask_flat, pred_flat, labels=range(NUM_CLASSES))
+SCORE = []
+save_dir = os.path.join("results", model_name, f"images{suffix}")
+checkIfFolderExists(save_dir)
+total_cm = np.zeros((NUM_CLASSES, NUM_CLASSES))
 
-    SCORE.append([name, f1_value, jac_value, recall_value, precision_value])
+# A single scoring thread keeps batches in order while the next batch is predicted
+names = [os.path.basename(x_path) for x_path in test_x]
+pending = []
+with ThreadPoolExecutor(max_workers=1) as scorer:
+    offset = 0
+    progress = tqdm(total=len(test_y))
+    for images, masks in test_dataset(test_x, test_y, batch_size):
+        preds = predictor.predict_classes(images.numpy())
+        batch_names = names[offset:offset + len(images)]
+        offset += len(images)
+        pending.append(scorer.submit(score_batch, batch_names, images.numpy(), masks.numpy(), preds))
+        progress.update(len(images))
+    progress.close()
+
+    for future in pending:
+        rows, batch_cm = future.result()
+        SCORE.extend(rows)
+        total_cm += batch_cm
 
 # ---------------- SAVE METRICS ----------------
 score_mean = np.mean([s[1:] for s in SCORE], axis=0)
-write_results_to_file(score_mean, os.path.join("results", model_name, "final_score.txt"))
+write_results_to_file(score_mean, os.path.join("results", model_name, f"final_score{suffix}.txt"))
+
+# ---------------- QUANTIZED MODEL ----------------
+# int8 model from quantization-aware fine-tuning (train.py with quantization_aware: true),
+# scored on the same images and appended below the float scores
+qat_tflite_path = os.path.join("results", model_name, f"{model_name}_qat_int8.tflite")
+if args.backend == "keras" and config_params.get("quantization_aware", False) and os.path.exists(qat_tflite_path):
+    int8_predictor = TFLitePredictor(qat_tflite_path)
+    int8_scores = []
+    for images, masks in tqdm(test_dataset(test_x, test_y, batch_size), total=int(np.ceil(len(test_y) / batch_size)), desc="int8"):
+        preds = int8_predictor.predict_classes(images.numpy())
+        int8_scores.extend(scores_from_confusion(confusion_matrices(masks.numpy(), preds, NUM_CLASSES)))
+    int8_mean = np.mean(int8_scores, axis=0)
+    write_results_to_file(int8_mean, os.path.join("results", model_name, "final_score.txt"),
+                          title=f"int8 (quantization-aware, {os.path.basename(qat_tflite_path)})", mode='a')
+    print(f"F1 float {score_mean[0]:.5f} -> int8 {int8_mean[0]:.5f}, "
+          f"Jaccard float {score_mean[1]:.5f} -> int8 {int8_mean[1]:.5f}")
 
 df = pd.DataFrame(SCORE, columns=["Image", "F1", "Jaccard", "Recall", "Precision"])
-df.to_csv(os.path.join("results", model_name, "testing_score.csv"), index=False)
+df.to_csv(os.path.join("results", model_name, f"testing_score{suffix}.csv"), index=False)
 
 print("\n--- Confusion Matrix (Rows: GT, Cols: Pred) ---")
 print(total_cm.astype(int))
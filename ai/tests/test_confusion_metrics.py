@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+from sklearn.metrics import confusion_matrix, f1_score, jaccard_score, precision_score, recall_score
+
+from metrics import NUM_CLASSES, confusion_matrices, scores_from_confusion
+
+H, W = 16, 16
+
+def sklearn_scores(gt, pred):
+    """[f1, jaccard, recall, precision] as test.py used to compute them with sklearn"""
+    gt, pred = gt.ravel(), pred.ravel()
+    labels = np.unique(gt)
+    kwargs = dict(labels=labels, average="macro", zero_division=0)
+    return np.array([
+        f1_score(gt, pred, **kwargs),
+        jaccard_score(gt, pred, **kwargs),
+        recall_score(gt, pred, **kwargs),
+        precision_score(gt, pred, **kwargs),
+    ])
+
+def random_masks(rng, shape):
+    return rng.integers(0, NUM_CLASSES, shape), rng.integers(0, NUM_CLASSES, shape)
+
+@pytest.mark.parametrize("seed", range(10))
+def test_single_image_matches_sklearn(seed):
+    gt, pred = random_masks(np.random.default_rng(seed), (H, W))
+    cm = confusion_matrices(gt, pred)
+    assert cm.shape == (NUM_CLASSES, NUM_CLASSES)
+    np.testing.assert_array_equal(cm, confusion_matrix(gt.ravel(), pred.ravel(), labels=range(NUM_CLASSES)))
+    np.testing.assert_allclose(scores_from_confusion(cm), sklearn_scores(gt, pred))
+
+def test_batch_matches_per_image():
+    gt, pred = random_masks(np.random.default_rng(0), (5, H, W))
+    cms = confusion_matrices(gt, pred)
+    assert cms.shape == (5, NUM_CLASSES, NUM_CLASSES)
+
+    scores = scores_from_confusion(cms)
+    assert scores.shape == (5, 4)
+    for i in range(len(gt)):
+        np.testing.assert_array_equal(cms[i], confusion_matrix(gt[i].ravel(), pred[i].ravel(), labels=range(NUM_CLASSES)))
+        np.testing.assert_allclose(scores[i], sklearn_scores(gt[i], pred[i]))
+
+    # total_cm in test.py: the whole test set in one matrix
+    np.testing.assert_array_equal(cms.sum(axis=0), confusion_matrix(gt.ravel(), pred.ravel(), labels=range(NUM_CLASSES)))
+
+def test_class_missing_from_ground_truth():
+    rng = np.random.default_rng(1)
+    gt, pred = random_masks(rng, (H, W))
+    gt[gt == 3] = 0  # class 3 only predicted, so it does not count in the macro average
+    pred[:2] = 3
+    np.testing.assert_allclose(scores_from_confusion(confusion_matrices(gt, pred)), sklearn_scores(gt, pred))
+
+def test_perfect_prediction():
+    gt = np.random.default_rng(2).integers(0, 3, (H, W))
+    scores = scores_from_confusion(confusion_matrices(gt, gt))
+    np.testing.assert_allclose(scores, np.ones(4))
+    np.testing.assert_allclose(scores, sklearn_scores(gt, gt))
@@ -0,0 +1,40 @@
+import numpy as np
+import tensorflow as tf
+
+from GradientAccumulation import GradientAccumulationModel, FlushAccumulatedGradients
+
+def build(accum_steps=None):
+    tf.keras.utils.set_random_seed(0)
+    inputs = tf.keras.Input((4,))
+    outputs = tf.keras.layers.Dense(1)(tf.keras.layers.Dense(3)(inputs))
+    if accum_steps is None:
+        model = tf.keras.Model(inputs, outputs)
+    else:
+        model = GradientAccumulationModel(inputs, outputs, accum_steps=accum_steps)
+    model.compile(optimizer=tf.keras.optimizers.SGD(0.1), loss="mse")
+    return model
+
+def data():
+    rng = np.random.default_rng(0)
+    return rng.random((8, 4), dtype=np.float32), rng.random((8, 1), dtype=np.float32)
+
+def test_one_accumulated_update_equals_the_full_batch():
+    x, y = data()
+    reference = build()
+    reference.fit(x, y, batch_size=8, epochs=1, shuffle=False, verbose=0)
+
+    model = build(accum_steps=2)
+    model.fit(x, y, batch_size=4, epochs=1, shuffle=False, verbose=0)
+
+    assert int(model.optimizer.iterations.numpy()) == 1
+    assert int(model.accum_step.numpy()) == 0
+    for a, b in zip(model.trainable_variables, reference.trainable_variables):
+        np.testing.assert_allclose(np.asarray(a), np.asarray(b), rtol=1e-5, atol=1e-6)
+
+def test_leftover_micro_batches_are_flushed_at_epoch_end():
+    x, y = data()
+    model = build(accum_steps=3)
+    # 4 micro-batches per epoch: one full accumulation plus one flushed leftover
+    model.fit(x, y, batch_size=2, epochs=2, shuffle=False, verbose=0, callbacks=[FlushAccumulatedGradients()])
+    assert int(model.optimizer.iterations.numpy()) == 4
+    assert int(model.accum_step.numpy()) == 0
@@ -1,5 +1,6 @@
 import os
 import sys
+import json
 import shutil
 from glob import glob
 # docker run --name my_tensorflow_1 -it --gpus all -v D:\Universitate_Politehnica\ARtemis-main:/workspace tensorflow/tensorflow:2.14.0-gpu bash
@@ -27,19 +28,33 @@ from tensorflow.keras.optimizers import Adam, SGD
 from sklearn.model_selection import train_test_split
 import numpy as np
 import cv2
-from tqdm import tqdm
 import yaml
 
-from image_proccessing import init_transform, apply_transform
-from unet import build_unet
-from metrics import dice_coef_multi, combined_loss, pixel_precision, per_class_precision
+import image_proccessing
+from image_proccessing import init_transform, apply_transform, apply_tf_transform
+from unet import build_unet, model_cost, print_model_cost, ENCODER_LAYER
+import metrics
+from metrics import combined_loss
+from class_histogram import update_class_histogram, class_weights
 from DicePerClass import DicePerClassMetric
+from train_callbacks import ThroughputLogger, StepTimingLogger, ProfilerWindow
+from GradientAccumulation import GradientAccumulationModel, FlushAccumulatedGradients
+from ConfusionMatrixMetric import ConfusionMatrixMetric
+from inference_backends import load_keras_model
+from quantization import quantize_aware_model, quantize_scope, export_int8_tflite
 
 # ---------------- GLOBAL PARAMETERS ----------------
 H = 256
 W = 256
 SEED = 42
-CONFIG_FILE_PATH = sys.argv[1]
+PRECISIONS = ["float32", "mixed_float16", "mixed_bfloat16"]
+CONFIG_FILE_PATH = sys.argv[1] if len(sys.argv) > 1 else None
+
+# Packed dataset (see pack_dataset.py): uint8 memory-mapped images/masks
+PACKED_DIR = "packed"
+PACKED_MANIFEST = "manifest.json"
+PACKED = None  # (images, masks) memmaps, set by load_packed_dataset
+PACKED_NAMES = None
 
 # ---------------- DEFINE MASK COLORS ----------------
 # Map each category index to a color (BGR) for normal data set
@@ -60,6 +75,11 @@ CLASS_COLORS = [
 ]
 
 NUM_CLASSES = len(CLASS_COLORS)
+CLASS_NAMES = ["background", "plastic", "paper", "bio", "metal", "other"]
+
+# Rare-class sampling frequencies used when the config has no "sampling" block.
+# Relative weights per image: the old oversampling replicated bio 21x, metal/other 6x.
+LEGACY_SAMPLING_FACTORS = {"bio": 21, "metal": 6, "other": 6}
 
 # ---------------- UTILITY FUNCTIONS ----------------
 def create_dir(path):
@@ -97,6 +117,33 @@ def load_dataset(path, split=0.2):
 
     return (train_x, train_y), (valid_x, valid_y), (test_x, test_y)
 
+def load_packed_dataset(path):
+    """Open the packed shards and return the train/valid/test splits as sample indices"""
+    global PACKED, PACKED_NAMES
+    manifest_path = os.path.join(path, PACKED_MANIFEST)
+    if not os.path.exists(manifest_path):
+        raise ValueError(f"No packed dataset found in {path}, run pack_dataset.py first")
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+    if (manifest["height"], manifest["width"]) != (H, W):
+        raise ValueError(f"Packed dataset is {manifest['height']}x{manifest['width']}, expected {H}x{W}")
+
+    images = np.load(os.path.join(path, "images.npy"), mmap_mode="r")
+    masks = np.load(os.path.join(path, "masks.npy"), mmap_mode="r")
+    PACKED = (images, masks)
+    PACKED_NAMES = manifest["names"]
+
+    # Images and masks share an index, so it serves as both X and Y
+    splits = manifest["splits"]
+    return tuple((splits[name], splits[name]) for name in ["train", "valid", "test"])
+
+def read_packed(index):
+    """Read an image/mask pair from the packed shards (no decoding)"""
+    images, masks = PACKED
+    x = np.float32(images[index]) / 255.0
+    y = np.array(masks[index])[:, :, np.newaxis]
+    return x, y
+
 def read_image(path):
     """Read image and normalize"""
     if isinstance(path, tf.Tensor):
@@ -108,79 +155,210 @@ def read_image(path):
     x = np.float32(x) / 255.0
     return x
 
+def color_to_class_mask(mask):
+    """Convert a legacy BGR color mask to class indices (nearest CLASS_COLORS entry)"""
+    # Robust matching using Euclidean distance to find nearest class color
+    diff = mask[:, :, np.newaxis, :] - np.array(CLASS_COLORS)[np.newaxis, np.newaxis, :, :]
+    dist = np.sum(np.square(diff), axis=-1)
+    return np.argmin(dist, axis=-1).astype(np.uint8)
+
 def read_mask(path):
-    """Read color mask and convert to multi-class one-hot"""
+    """Read a single-channel class-index mask (legacy color masks are converted)"""
     if isinstance(path, tf.Tensor):
         path = path.numpy()
     if isinstance(path, bytes):
         path = path.decode()
-    mask = cv2.imread(path, cv2.IMREAD_COLOR)
+    mask = cv2.imread(path, cv2.IMREAD_UNCHANGED)
     mask = cv2.resize(mask, (W, H), interpolation=cv2.INTER_NEAREST)
 
-    # Robust matching using Euclidean distance to find nearest class color
-    diff = mask[:, :, np.newaxis, :] - np.array(CLASS_COLORS)[np.newaxis, np.newaxis, :, :]
-    dist = np.sum(np.square(diff), axis=-1)
-    class_mask = np.argmin(dist, axis=-1).astype(np.uint8)
+    # Datasets preprocessed before index masks store BGR colors instead
+    if mask.ndim == 3:
+        mask = color_to_class_mask(mask[:, :, :3])
 
-    return np.expand_dims(class_mask, axis=-1)
+    return np.expand_dims(mask.astype(np.uint8), axis=-1)
 
-def oversample_dataset(images, masks):
-    """Oversample images containing rare classes to balance the dataset"""
-    print("Scanning dataset for oversampling (this might take a moment)...")
-    aug_images = []
-    aug_masks = []
-    
-    for x, y in tqdm(zip(images, masks), total=len(images)):
-        aug_images.append(x)
-        aug_masks.append(y)
-        
-        # Read mask to check for rare classes
-        # We use the robust read_mask function to ensure we catch them
-        mask = read_mask(y) # returns (H, W, 1) with class indices
-        present_classes = np.unique(mask)
-        
-        # Class 3 (Bio) is extremely rare -> Replicate 20x
-        if 3 in present_classes:
-            for _ in range(20):
-                aug_images.append(x)
-                aug_masks.append(y)
-        # Class 4 (Metal) and 5 (Other) -> Replicate 5x
-        elif 4 in present_classes or 5 in present_classes:
-            for _ in range(5):
-                aug_images.append(x)
-                aug_masks.append(y)
-                
-    print(f"Oversampling complete. Original: {len(images)} -> Augmented: {len(aug_images)}")
-    return aug_images, aug_masks
+def class_histogram_table(dataset_path, Y):
+    """Per-image class pixel counts (N x NUM_CLASSES) for Y, from the dataset's histogram index"""
+    names, counts = update_class_histogram(dataset_path, read_mask=lambda p: read_mask(p)[:, :, 0])
+    rows = {name: row for name, row in zip(names, counts)}
+    if PACKED is not None:
+        keys = [PACKED_NAMES[y] for y in Y]
+    else:
+        keys = [os.path.splitext(os.path.basename(y))[0] for y in Y]
+    missing = [k for k in keys if k not in rows]
+    if missing:
+        raise ValueError(f"{len(missing)} samples missing from the class histogram index, e.g. {missing[0]}")
+    return np.stack([rows[k] for k in keys])
+
+def sampling_strata(histogram, sampling_config):
+    """Group images by the rarest sampled class they contain and weight each group.
+
+    sampling_config is either a dict mapping class names to the target fraction of
+    sampled images containing that class (images without any of them form stratum 0,
+    which receives the remaining probability mass), or one of the class_weights methods,
+    in which case every stratum is weighted by its size times the class weight.
+    Without a config the weights reproduce the class mix of the old list-replication
+    oversampling.
+    """
+    if sampling_config is not None and not isinstance(sampling_config, (str, dict)):
+        raise ValueError(f"Invalid sampling config {sampling_config!r}: expected false, a class_weights method "
+                         "or a mapping of class names to target fractions")
+    presence = histogram > 0
+    if sampling_config is None:
+        targets = LEGACY_SAMPLING_FACTORS
+    elif isinstance(sampling_config, str):
+        targets = dict(zip(CLASS_NAMES[1:], class_weights(histogram, sampling_config)[1:]))
+    else:
+        targets = sampling_config
+    for name in targets:
+        if name not in CLASS_NAMES[1:]:
+            raise ValueError(f"Unknown class '{name}' in sampling config")
+    classes = [CLASS_NAMES.index(name) for name in targets]
+
+    # Rarest class wins, so an image with bio and plastic is sampled as bio
+    classes.sort(key=lambda c: presence[:, c].sum(), reverse=True)
+    strata = np.zeros(len(presence), dtype=np.int64)
+    for c in classes:
+        strata[presence[:, c]] = c
+
+    counts = {c: int(np.sum(strata == c)) for c in [0] + classes}
+    if isinstance(sampling_config, dict):
+        weights = {c: float(targets[CLASS_NAMES[c]]) for c in classes}
+        targeted = sum(weights.values())
+        if targeted >= 1.0 and counts[0] > 0:
+            raise ValueError(f"Sampling targets add up to {targeted:g}, leaving nothing for the {counts[0]} images "
+                             "without any of these classes; keep their sum below 1")
+        weights[0] = max(0.0, 1.0 - targeted)
+    else:
+        common = 1.0 if sampling_config is None else class_weights(histogram, sampling_config)[0]
+        weights = {c: counts[c] * (targets[CLASS_NAMES[c]] if c else common) for c in counts}
+
+    # Empty strata cannot be sampled from
+    weights = {c: w for c, w in weights.items() if counts[c] > 0 and w > 0}
+    total = sum(weights.values())
+    weights = {c: w / total for c, w in weights.items()}
+
+    for c, w in weights.items():
+        print(f"Sampling stratum {CLASS_NAMES[c] if c else 'common'}: {counts[c]} images, frequency {w:.3f}")
+    return strata, weights
 
 def tf_parse(X, Y, use_augmentation=True):
     """TF Dataset parsing function for multi-class masks"""
     def _parse(x, y):
-        img = read_image(x)
-        mask = read_mask(y)
+        if PACKED is not None:
+            img, mask = read_packed(x)
+        else:
+            img = read_image(x)
+            mask = read_mask(y)
         if use_augmentation:
             transformed = apply_transform(img, mask)
             img = transformed['image']
             mask = transformed['mask']
         
-        # Convert to one-hot after augmentation to preserve integrity
-        mask_ind = mask[:, :, 0]
-        one_hot = np.eye(NUM_CLASSES)[mask_ind]
-        return img, np.float32(one_hot)
+        # Labels stay uint8 class indices, the loss builds the one-hot view in the graph
+        return img, np.ascontiguousarray(mask[:, :, :1], dtype=np.uint8)
 
-    x, y = tf.numpy_function(_parse, [X, Y], [tf.float32, tf.float32])
+    x, y = tf.numpy_function(_parse, [X, Y], [tf.float32, tf.uint8])
     x.set_shape([H, W, 3])
-    y.set_shape([H, W, NUM_CLASSES])
+    y.set_shape([H, W, 1])
     return x, y
 
-def tf_dataset(X, Y, batch=2, use_augmentation=True):
-    dataset = tf.data.Dataset.from_tensor_slices((X, Y))
-    dataset = dataset.shuffle(buffer_size=5000)
-    dataset = dataset.map(lambda x, y: tf_parse(x, y, use_augmentation))
+def tf_read_image(path):
+    """Graph-native read_image: decode, resize and normalize"""
+    x = tf.io.decode_image(tf.io.read_file(path), channels=3, expand_animations=False)
+    x = tf.reverse(x, axis=[-1])  # RGB -> BGR, as returned by cv2.imread
+    x = tf.image.resize(x, (H, W), method="bilinear")
+    return x / 255.0
+
+def tf_color_to_class_mask(mask):
+    """Graph-native color_to_class_mask for legacy (RGB-decoded) color masks"""
+    bgr = tf.reverse(tf.cast(mask[:, :, :3], tf.int32), axis=[-1])
+    diff = bgr[:, :, tf.newaxis, :] - tf.constant(CLASS_COLORS, dtype=tf.int32)[tf.newaxis, tf.newaxis, :, :]
+    dist = tf.reduce_sum(tf.square(diff), axis=-1)
+    return tf.cast(tf.argmin(dist, axis=-1), tf.uint8)[:, :, tf.newaxis]
+
+def tf_read_mask(path):
+    """Graph-native read_mask: (H, W, 1) uint8 class indices"""
+    mask = tf.io.decode_png(tf.io.read_file(path), channels=0)
+    mask = tf.image.resize(mask, (H, W), method="nearest")
+    mask = tf.cond(
+        tf.shape(mask)[-1] == 1,
+        lambda: mask[:, :, :1],
+        lambda: tf_color_to_class_mask(mask),
+    )
+    return mask
+
+def tf_parse_graph(X, Y, use_augmentation=True):
+    """TF Dataset parsing function built from graph ops (augmentation backend: tensorflow)"""
+    if PACKED is not None:
+        x, y = tf.numpy_function(read_packed, [X], [tf.float32, tf.uint8])
+    else:
+        x = tf_read_image(X)
+        y = tf_read_mask(Y)
+    x.set_shape([H, W, 3])
+    y.set_shape([H, W, 1])
+
+    if use_augmentation:
+        x, y = apply_tf_transform(x, y)
+
+    return x, tf.cast(y, tf.uint8)
+
+def weighted_source(X, Y, strata, weights):
+    """Endless (x, y) stream drawing each stratum with its weight, without duplicating paths"""
+    X, Y = np.asarray(X), np.asarray(Y)
+    datasets = []
+    for c in weights:
+        idx = np.flatnonzero(strata == c)
+        ds = tf.data.Dataset.from_tensor_slices((X[idx], Y[idx]))
+        datasets.append(ds.shuffle(buffer_size=len(idx)).repeat())
+    return tf.data.Dataset.sample_from_datasets(datasets, weights=list(weights.values()), seed=SEED)
+
+def tf_dataset(X, Y, batch=2, use_augmentation=True, strata=None, strata_weights=None):
+    if strata is None:
+        dataset = tf.data.Dataset.from_tensor_slices((X, Y))
+        dataset = dataset.shuffle(buffer_size=5000)
+    else:
+        dataset = weighted_source(X, Y, strata, strata_weights)
+    if image_proccessing.AUGMENTATION_BACKEND == "tensorflow":
+        dataset = dataset.map(
+            lambda x, y: tf_parse_graph(x, y, use_augmentation),
+            num_parallel_calls=tf.data.AUTOTUNE
+        )
+    else:
+        dataset = dataset.map(lambda x, y: tf_parse(x, y, use_augmentation))
     dataset = dataset.batch(batch)
     dataset = dataset.prefetch(tf.data.AUTOTUNE)
     return dataset
 
+# ---------------- MODEL ----------------
+def compile_model(model, optimizer_name, lr, precision, jit_compile):
+    """Compile with combined_loss and a fresh optimizer"""
+    if optimizer_name == "Adam":
+        optimizer = Adam(lr)
+    elif optimizer_name == "SGD":
+        optimizer = SGD(lr)
+    else:
+        raise Exception("Unknown optimizer")
+    if precision == "mixed_float16":
+        # Dynamic loss scaling keeps float16 gradients from underflowing
+        optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+
+    model.compile(
+        loss=combined_loss,
+        optimizer=optimizer,
+        metrics=[ConfusionMatrixMetric(NUM_CLASSES)],
+        jit_compile=jit_compile,
+    )
+
+def set_encoder_trainable(model, trainable):
+    """Freeze/unfreeze the pretrained encoder. Its BatchNormalization layers always stay in
+    inference mode: statistics of 2-image batches would overwrite the pretrained ones."""
+    encoder = model.get_layer(ENCODER_LAYER)
+    encoder.trainable = trainable
+    for layer in encoder.layers:
+        if isinstance(layer, tf.keras.layers.BatchNormalization):
+            layer.trainable = False
+
 # ---------------- MAIN ----------------
 if __name__ == "__main__":
     np.random.seed(SEED)
@@ -198,58 +376,162 @@ if __name__ == "__main__":
     create_dir(f"results/{model_name}")
     model_path = os.path.join("results", model_name, f"{model_name}.h5")
     csv_path = os.path.join("results", model_name, "training_log.csv")
+    step_log_path = os.path.join("results", model_name, "step_log.csv")
+    config_copy_path = os.path.join("results", model_name, "config.yaml")
+
+    # Quantization-aware fine-tuning starts from the trained float model and writes next to it
+    quantization_aware = bool(config_params.get("quantization_aware", False))
+    if quantization_aware:
+        float_model_path = model_path
+        model_path = os.path.join("results", model_name, f"{model_name}_qat.h5")
+        csv_path = os.path.join("results", model_name, "training_log_qat.csv")
+        step_log_path = os.path.join("results", model_name, "step_log_qat.csv")
+        config_copy_path = os.path.join("results", model_name, "config_qat.yaml")  # keeps the float run's config.yaml
+        tflite_path = os.path.join("results", model_name, f"{model_name}_qat_int8.tflite")
     print(f"Model will be saved to: {model_path}")
 
     # Load dataset
     dataset_path = "./post_dataset_taco"
-    (train_x, train_y), (valid_x, valid_y), (test_x, test_y) = load_dataset(dataset_path)
+    if config_params.get("packed", False):
+        (train_x, train_y), (valid_x, valid_y), (test_x, test_y) = load_packed_dataset(
+            os.path.join(dataset_path, PACKED_DIR)
+        )
+    else:
+        (train_x, train_y), (valid_x, valid_y), (test_x, test_y) = load_dataset(dataset_path)
     print(f"Train: {len(train_x)}, Valid: {len(valid_x)}, Test: {len(test_x)}")
 
-    # Apply oversampling to training data
-    train_x, train_y = oversample_dataset(train_x, train_y)
+    # Per-image class pixel counts, read from the index written by preprocess_taco.py
+    histogram = class_histogram_table(dataset_path, train_y)
 
-    # TF datasets
+    # Loss weights: hand-tuned CLASS_WEIGHTS unless the config asks to derive them
+    weight_config = config_params.get("class_weights")
+    if isinstance(weight_config, list):
+        metrics.set_class_weights(weight_config)
+    elif weight_config is not None:
+        # Keep the overall loss magnitude of the hand-tuned weights
+        scale = float(tf.reduce_mean(metrics.CLASS_WEIGHTS))
+        metrics.set_class_weights(class_weights(histogram, weight_config) * scale)
+    print(f"Class weights: {np.round(metrics.CLASS_WEIGHTS.numpy(), 3).tolist()}")
+
+    # Class-aware sampling of training data ("sampling: false" disables it)
     batch_size = int(config_params.get("batch_size", 2))
-    train_dataset = tf_dataset(train_x, train_y, batch=batch_size, use_augmentation=True)
+    sampling_config = config_params.get("sampling")
+    if sampling_config is False:
+        strata, strata_weights, steps_per_epoch = None, None, None
+    else:
+        strata, strata_weights = sampling_strata(histogram, sampling_config)
+        # The weighted stream is endless, an epoch still covers len(train_x) samples
+        steps_per_epoch = int(np.ceil(len(train_x) / batch_size))
+
+    # TF datasets
+    train_dataset = tf_dataset(train_x, train_y, batch=batch_size, use_augmentation=True,
+                               strata=strata, strata_weights=strata_weights)
     valid_dataset = tf_dataset(valid_x, valid_y, batch=batch_size, use_augmentation=False)
 
+    # Precision policy, set before the model is built (the softmax head stays float32)
+    precision = config_params.get("precision", "float32")
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision}, expected one of {PRECISIONS}")
+    tf.keras.mixed_precision.set_global_policy(precision)
+    jit_compile = bool(config_params.get("jit_compile", False))
+    print(f"Precision: {precision}, XLA: {jit_compile}")
+
     # Build model
     config_params["num_classes"] = NUM_CLASSES
-    model = build_unet((H, W, 3), config_params)
+    if quantization_aware:
+        if precision != "float32":
+            raise ValueError("quantization_aware needs precision: float32")
+        print(f"Quantization-aware fine-tuning of {float_model_path}")
+        model = quantize_aware_model(load_keras_model(float_model_path, compile=False))
+    else:
+        model = build_unet((H, W, 3), config_params)
+
+        # Size/speed of the variant, kept next to the training log for accuracy-vs-latency sweeps
+        cost = model_cost(model, latency_runs=int(config_params.get("latency_runs", 10)))
+        print_model_cost(cost)
+        with open(os.path.join("results", model_name, "model_cost.json"), "w") as f:
+            json.dump(cost, f, indent=2)
+
+    # Gradients summed over grad_accum_steps micro-batches before each update
+    grad_accum_steps = int(config_params.get("grad_accum_steps", 1))
+    if grad_accum_steps > 1:
+        model = GradientAccumulationModel(model.inputs, model.outputs, accum_steps=grad_accum_steps, name=model.name)
+        print(f"Gradient accumulation: {grad_accum_steps} steps, effective batch size {batch_size * grad_accum_steps}")
     optimizer = config_params.get("optimizer", "Adam")
     loss_type = config_params.get("loss", "DiceMultiLoss")
     lr = float(config_params.get("lr", 1e-4))
+    num_epochs = int(config_params.get("num_epochs", 100))
+    if quantization_aware:
+        # A few epochs at a low learning rate are enough for the weights to adapt to int8
+        lr = float(config_params.get("qat_lr", 1e-5))
+        num_epochs = int(config_params.get("qat_epochs", 3))
 
-    if optimizer == "Adam":
-        model.compile(
-            loss=combined_loss,
-            optimizer=Adam(lr),
-            metrics=[dice_coef_multi, pixel_precision, per_class_precision]
-        )
-    elif optimizer == "SGD":
-        model.compile(
-            loss=combined_loss,
-            optimizer=SGD(lr),
-            metrics=[dice_coef_multi, pixel_precision, per_class_precision]
-        )
-    else:
-        raise Exception("Unknown loss type")
+    # Pretrained encoder, optionally frozen for the first freeze_encoder_epochs epochs
+    has_encoder = config_params.get("encoder", "plain") != "plain"
+    freeze_epochs = min(int(config_params.get("freeze_encoder_epochs", 0)), num_epochs) if has_encoder else 0
+    if has_encoder:
+        set_encoder_trainable(model, freeze_epochs == 0)
+
+    compile_model(model, optimizer, lr, precision, jit_compile)
 
     # Callbacks
+    csv_logger = CSVLogger(csv_path)
+    step_logger = StepTimingLogger(batch_size, step_log_path)
+    train_dataset = step_logger.wrap(train_dataset)
     callbacks = [
         ModelCheckpoint(model_path, verbose=1, save_best_only=True),
         ReduceLROnPlateau(monitor='val_loss', factor=0.1, patience=5, min_lr=1e-7, verbose=1),
-        CSVLogger(csv_path),
+        ThroughputLogger(batch_size),
+        step_logger,
+        csv_logger,
         EarlyStopping(monitor='val_loss', patience=20, restore_best_weights=False),
     ]
 
+    # Updates from leftover micro-batches are applied at the end of each epoch
+    if grad_accum_steps > 1:
+        callbacks.insert(0, FlushAccumulatedGradients())
+
+    # Profiler trace of a window of training steps ("profile: {start_step, num_steps}")
+    profile_config = config_params.get("profile")
+    if profile_config:
+        profile_config = profile_config if isinstance(profile_config, dict) else {}
+        callbacks.insert(0, ProfilerWindow(os.path.join("results", model_name, "profile"),
+                                           start_step=int(profile_config.get("start_step", 10)),
+                                           num_steps=int(profile_config.get("num_steps", 5))))
+
     # Training
-    model.fit(
-        train_dataset,
-        epochs=int(config_params.get("num_epochs", 100)),
-        validation_data=valid_dataset,
-        callbacks=callbacks
-    )
+    if freeze_epochs > 0:
+        print(f"Training with a frozen encoder for {freeze_epochs} epochs")
+        model.fit(
+            train_dataset,
+            epochs=freeze_epochs,
+            steps_per_epoch=steps_per_epoch,
+            validation_data=valid_dataset,
+            callbacks=callbacks
+        )
+        # Unfreeze and continue with a fresh optimizer at the learning rate reached so far
+        set_encoder_trainable(model, True)
+        lr = float(tf.keras.backend.get_value(model.optimizer.learning_rate))
+        compile_model(model, optimizer, lr, precision, jit_compile)
+        csv_logger.append = True
+        print(f"Encoder unfrozen at epoch {freeze_epochs}, lr {lr:g}")
+
+    if num_epochs > freeze_epochs:
+        model.fit(
+            train_dataset,
+            epochs=num_epochs,
+            initial_epoch=freeze_epochs,
+            steps_per_epoch=steps_per_epoch,
+            validation_data=valid_dataset,
+            callbacks=callbacks
+        )
+
+    # int8 export from the best checkpoint, scored by test.py next to the float model
+    if quantization_aware:
+        with quantize_scope():
+            model.load_weights(model_path)
+        size = export_int8_tflite(model, tflite_path)
+        print(f"Saved {tflite_path}: {size / 2**20:.2f} MB")
 
     # Save config
-    shutil.copyfile(CONFIG_FILE_PATH, os.path.join("results", model_name, "config.yaml"))
+    shutil.copyfile(CONFIG_FILE_PATH, config_copy_path)
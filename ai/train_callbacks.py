@@ -0,0 +1,150 @@
+import csv
+import time
+from collections import deque
+import tensorflow as tf
+
+from memory_usage import reset_peak_memory, peak_memory_mb, current_memory_mb
+
+# ---------------- THROUGHPUT ----------------
+class ThroughputLogger(tf.keras.callbacks.Callback):
+    """Adds images_per_sec and peak_memory_mb (training part of the epoch) to the epoch logs.
+
+    Must come before CSVLogger in the callback list so the values end up in training_log.csv.
+    """
+    def __init__(self, batch_size):
+        super().__init__()
+        self.batch_size = batch_size
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.steps = 0
+        self.start = None
+        self.end = None
+        reset_peak_memory()
+
+    def on_train_batch_begin(self, batch, logs=None):
+        if self.start is None:
+            self.start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.steps += 1
+        self.end = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        if logs is None or self.start is None:
+            return
+        # Validation runs before on_epoch_end, so the window stops at the last training batch
+        logs["images_per_sec"] = self.steps * self.batch_size / max(self.end - self.start, 1e-9)
+        logs["peak_memory_mb"] = peak_memory_mb()
+
+# ---------------- STEP TIMING ----------------
+class StepTimingLogger(tf.keras.callbacks.Callback):
+    """Per-step timing in a CSV (one row per training step): step time split into data wait
+    and compute, images/sec and current memory (RSS, or the TF allocator, see memory_usage).
+    Also adds the epoch means step_ms and data_wait_ms to the epoch logs, so like
+    ThroughputLogger it must come before CSVLogger.
+
+    Keras fetches the next batch inside the train function, so the wait cannot be timed from
+    the callbacks alone: wrap() stamps each batch as it leaves the input pipeline, and a step
+    waited for data as long as its batch was not ready when the step started. The first step
+    of a fit() also traces the train function, which shows up in both columns.
+    """
+    FIELDS = ["epoch", "step", "global_step", "step_ms", "data_wait_ms", "compute_ms", "images_per_sec", "memory_mb"]
+
+    def __init__(self, batch_size, path):
+        super().__init__()
+        self.batch_size = batch_size
+        self.path = path
+        self.ready = deque()
+        self.global_step = 0
+
+    def _stamp(self):
+        now = time.perf_counter()
+        self.ready.append(now)
+        return now
+
+    def wrap(self, dataset):
+        """The stamp pulls from the pipeline's own prefetch buffer into a second one: a batch
+        already waiting is stamped right away, one still being produced when it is done"""
+        def stamp(*batch):
+            tick = tf.py_function(self._stamp, [], tf.float64)
+            with tf.control_dependencies([tick]):
+                return tuple(tf.identity(t) for t in batch)
+        return dataset.map(stamp).prefetch(tf.data.AUTOTUNE)
+
+    def on_train_begin(self, logs=None):
+        # Batches left in the prefetch buffer by a previous fit() were stamped but never used
+        self.ready.clear()
+        # A second fit() (frozen encoder, then unfrozen) continues the same file
+        resume = self.global_step > 0
+        self.file = open(self.path, "a" if resume else "w", newline="")
+        self.writer = csv.writer(self.file)
+        if not resume:
+            self.writer.writerow(self.FIELDS)
+
+    def on_train_end(self, logs=None):
+        self.file.close()
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+        self.steps = []
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.begin = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        step = time.perf_counter() - self.begin
+        ready = self.ready.popleft() if self.ready else self.begin
+        wait = min(max(ready - self.begin, 0.0), step)
+        self.global_step += 1
+        self.steps.append((step, wait))
+        self.writer.writerow([self.epoch, batch, self.global_step, f"{1000 * step:.2f}", f"{1000 * wait:.2f}",
+                              f"{1000 * (step - wait):.2f}", f"{self.batch_size / max(step, 1e-9):.2f}",
+                              f"{current_memory_mb():.1f}"])
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.file.flush()
+        if logs is None or not self.steps:
+            return
+        logs["step_ms"] = 1000 * sum(s for s, _ in self.steps) / len(self.steps)
+        logs["data_wait_ms"] = 1000 * sum(w for _, w in self.steps) / len(self.steps)
+
+# ---------------- PROFILER ----------------
+class ProfilerWindow(tf.keras.callbacks.Callback):
+    """TensorFlow profiler trace of global training steps [start_step, start_step + num_steps)
+    into logdir, for TensorBoard's profile tab (step time breakdown, input pipeline analyzer).
+    Steps are counted across fit() calls."""
+    def __init__(self, logdir, start_step=10, num_steps=5):
+        super().__init__()
+        self.logdir = logdir
+        self.start_step = start_step
+        self.stop_step = start_step + num_steps
+        self.global_step = 0
+        self.active = False
+        self.trace = None
+
+    def on_train_batch_begin(self, batch, logs=None):
+        if self.global_step == self.start_step:
+            print(f"\nProfiling steps {self.start_step}-{self.stop_step - 1} into {self.logdir}")
+            tf.profiler.experimental.start(self.logdir)
+            self.active = True
+        if self.active:
+            # Step markers let the profiler split the trace into training steps
+            self.trace = tf.profiler.experimental.Trace("train", step_num=self.global_step, _r=1)
+            self.trace.__enter__()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.global_step += 1
+        if self.trace is not None:
+            self.trace.__exit__(None, None, None)
+            self.trace = None
+        if self.active and self.global_step >= self.stop_step:
+            self._stop()
+
+    def on_train_end(self, logs=None):
+        if self.active:
+            self._stop()
+
+    def _stop(self):
+        tf.profiler.experimental.stop()
+        self.active = False
+        print(f"\nProfiler trace saved to {self.logdir}")
@@ -1,62 +1,302 @@
-from tensorflow.keras.layers import Conv2D, GroupNormalization, Activation, MaxPool2D, Conv2DTranspose, Concatenate, Input
+import time
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.layers import Conv2D, SeparableConv2D, DepthwiseConv2D, GroupNormalization, Activation, MaxPool2D, Conv2DTranspose, Concatenate, Input, Layer
 from tensorflow.keras.models import Model
 
-def conv_block(inputs, num_filters):
-    x = Conv2D(num_filters, 3, padding="same")(inputs)
-    x = GroupNormalization(groups=8)(x)
+BASE_FILTERS = 64
+DEFAULT_DEPTH = 4  # encoder levels, the bridge sits below the last one
+GROUPS = 8  # GroupNormalization groups, filter counts are rounded to a multiple of this
+
+# Pretrained encoders: Keras applications backbone, layers tapped at strides 2, 4, 8, 16
+# (skip connections) and 32 (bottleneck), and the scale/offset of the RGB input it expects
+ENCODERS = {
+    "mobilenetv2": (
+        tf.keras.applications.MobileNetV2,
+        ["block_1_expand_relu", "block_3_expand_relu", "block_6_expand_relu", "block_13_expand_relu", "out_relu"],
+        2.0, -1.0,  # RGB in [-1, 1]
+    ),
+    "efficientnetb0": (
+        tf.keras.applications.EfficientNetB0,
+        ["block2a_expand_activation", "block3a_expand_activation", "block4a_expand_activation",
+         "block6a_expand_activation", "top_activation"],
+        255.0, 0.0,  # RGB in [0, 255], normalized inside the model
+    ),
+}
+# Per-channel ImageNet std of keras.applications.efficientnet, see build_encoder
+IMAGENET_STDDEV_RGB = [0.229, 0.224, 0.225]
+# EfficientNet-Lite is not part of keras.applications, B0 is the closest backbone available
+ENCODER_ALIASES = {"efficientnet-lite": "efficientnetb0"}
+ENCODER_LAYER = "encoder"
+DECODER_FILTERS = [16, 32, 64, 128, 256]  # decoder filters at strides 1, 2, 4, 8, 16
+
+def _conv(num_filters, separable=False):
+    if separable:
+        return SeparableConv2D(num_filters, 3, padding="same")
+    return Conv2D(num_filters, 3, padding="same")
+
+def conv_block(inputs, num_filters, separable=False):
+    x = _conv(num_filters, separable)(inputs)
+    x = GroupNormalization(groups=GROUPS)(x)
     x = Activation("relu")(x)
 
-    x = Conv2D(num_filters, 3, padding="same")(x)
-    x = GroupNormalization(groups=8)(x)
+    x = _conv(num_filters, separable)(x)
+    x = GroupNormalization(groups=GROUPS)(x)
     x = Activation("relu")(x)
 
     return x
 
-def encoder_block(inputs, num_filters):
-    x = conv_block(inputs, num_filters)
+class ConvBlock(Layer):
+    """conv_block as one layer. With remat=True only the block input is kept for the
+    backward pass; the conv/norm/relu activations inside are recomputed from it."""
+    def __init__(self, num_filters, remat=False, separable=False, **kwargs):
+        super().__init__(**kwargs)
+        self.num_filters = num_filters
+        self.remat = remat
+        self.separable = separable
+        self.conv1 = _conv(num_filters, separable)
+        self.norm1 = GroupNormalization(groups=GROUPS)
+        self.conv2 = _conv(num_filters, separable)
+        self.norm2 = GroupNormalization(groups=GROUPS)
+
+    def build(self, input_shape):
+        # Variables must exist before call(), they cannot be created inside tf.recompute_grad
+        output_shape = tuple(input_shape[:-1]) + (self.num_filters,)
+        for layer, shape in [(self.conv1, input_shape), (self.norm1, output_shape),
+                             (self.conv2, output_shape), (self.norm2, output_shape)]:
+            # Name scope per sublayer keeps weight names unique in .h5 files
+            with tf.name_scope(layer.name):
+                layer.build(shape)
+        super().build(input_shape)
+
+    def _forward(self, inputs):
+        x = tf.nn.relu(self.norm1(self.conv1(inputs)))
+        return tf.nn.relu(self.norm2(self.conv2(x)))
+
+    def call(self, inputs):
+        if self.remat:
+            return tf.recompute_grad(self._forward)(inputs)
+        return self._forward(inputs)
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({"num_filters": self.num_filters, "remat": self.remat, "separable": self.separable})
+        return config
+
+def block(inputs, num_filters, remat=False, separable=False):
+    if remat:
+        return ConvBlock(num_filters, remat=True, separable=separable)(inputs)
+    return conv_block(inputs, num_filters, separable)
+
+def encoder_block(inputs, num_filters, remat=False, separable=False):
+    x = block(inputs, num_filters, remat, separable)
     p = MaxPool2D((2, 2))(x)
     return x, p
 
-def decoder_block(inputs, skip_features, num_filters):
+def decoder_block(inputs, skip_features, num_filters, remat=False, separable=False):
     x = Conv2DTranspose(num_filters, 2, strides=2, padding="same")(inputs)
     x = Concatenate()([x, skip_features])
-    x = conv_block(x, num_filters)
+    x = block(x, num_filters, remat, separable)
     return x
 
+def round_filters(num_filters):
+    return max(GROUPS, int(round(num_filters / GROUPS)) * GROUPS)
+
+def unet_filters(config_data):
+    """Filters per encoder level plus the bridge, e.g. [64, 128, 256, 512, 1024] by default.
+    An explicit `filters` list wins over `width_multiplier` and `depth`."""
+    if config_data.get("filters") is not None:
+        return [round_filters(f) for f in config_data["filters"]]
+    width = float(config_data.get("width_multiplier", 1.0))
+    depth = int(config_data.get("depth", DEFAULT_DEPTH))
+    return [round_filters(BASE_FILTERS * 2**i * width) for i in range(depth + 1)]
+
+def build_encoder(input_shape, config_data):
+    """Keras applications backbone as a multi-output model (skips at strides 2..16, bottleneck last).
+    Weights come from a local file only (encoder_weights), nothing is downloaded."""
+    name = ENCODER_ALIASES.get(config_data["encoder"], config_data["encoder"])
+    if name not in ENCODERS:
+        raise ValueError(f"Unknown encoder {config_data['encoder']}, expected plain, "
+                         f"{', '.join(list(ENCODERS) + list(ENCODER_ALIASES))}")
+    if name != config_data["encoder"]:
+        print(f"Encoder {config_data['encoder']} is not available in keras.applications, using {name}")
+
+    constructor, taps, scale, offset = ENCODERS[name]
+    kwargs = {"alpha": float(config_data.get("encoder_alpha", 1.0))} if name == "mobilenetv2" else {}
+    backbone = constructor(input_shape=input_shape, include_top=False, weights=None, **kwargs)
+
+    weights_path = config_data.get("encoder_weights")
+    if weights_path:
+        backbone.load_weights(weights_path)
+        print(f"Encoder weights loaded from {weights_path}")
+        if name == "efficientnetb0":
+            # keras.applications follows Normalization with Rescaling(1 / sqrt(IMAGENET_STDDEV_RGB))
+            # only for weights="imagenet"; the same per-channel factor is folded into its variance
+            normalization = next(l for l in backbone.layers if isinstance(l, tf.keras.layers.Normalization))
+            mean, variance, *rest = normalization.get_weights()
+            normalization.set_weights([mean, variance * np.array(IMAGENET_STDDEV_RGB, dtype=np.float32)] + rest)
+    else:
+        print(f"No encoder_weights given, the {name} encoder starts from random weights")
+
+    encoder = Model(backbone.input, [backbone.get_layer(t).output for t in taps], name=ENCODER_LAYER)
+    return encoder, scale, offset
+
+def decoder_filters(config_data):
+    """Decoder filters at strides 1..16 for a pretrained encoder; `filters` (5 values) wins"""
+    if config_data.get("filters") is not None:
+        if len(config_data["filters"]) != len(DECODER_FILTERS):
+            raise ValueError(f"filters needs {len(DECODER_FILTERS)} values (strides 1..16) with a pretrained encoder")
+        return [round_filters(f) for f in config_data["filters"]]
+    width = float(config_data.get("width_multiplier", 1.0))
+    return [round_filters(f * width) for f in DECODER_FILTERS]
+
+def build_encoder_unet(input_shape, config_data):
+    """U-Net decoder on top of a pretrained encoder (see build_encoder)"""
+    NUM_CLASSES = config_data.get("num_classes", 5)
+    remat = bool(config_data.get("remat", False))
+    separable = bool(config_data.get("separable", False))
+    filters = decoder_filters(config_data)
+
+    if input_shape[0] % 32 or input_shape[1] % 32:
+        raise ValueError(f"Input size {input_shape[:2]} is not divisible by 32")
+
+    encoder, scale, offset = build_encoder(input_shape, config_data)
+    inputs = Input(input_shape)
+
+    # Training images are BGR in [0, 1] (cv2); a fixed 1x1 conv reorders and rescales them
+    # for the backbone, so the exported model keeps the same input as the plain U-Net
+    adapter = Conv2D(3, 1, trainable=False, name="input_adapter")
+    x = adapter(inputs)
+    kernel = np.zeros((1, 1, 3, 3), dtype=np.float32)
+    for c in range(3):
+        kernel[0, 0, 2 - c, c] = scale
+    adapter.set_weights([kernel, np.full(3, offset, dtype=np.float32)])
+
+    *skips, x = encoder(x)
+
+    # Decoder
+    for num_filters, s in zip(reversed(filters[1:]), reversed(skips)):
+        x = decoder_block(x, s, num_filters, remat, separable)
+    # Last upsampling back to the input resolution has no skip connection
+    x = Conv2DTranspose(filters[0], 2, strides=2, padding="same")(x)
+    x = block(x, filters[0], remat, separable)
+
+    # Multi-class output (kept in float32 under mixed precision for a stable softmax and loss)
+    outputs = Conv2D(NUM_CLASSES, 1, padding="same", activation="softmax", dtype="float32")(x)
+
+    model = Model(inputs, outputs, name=config_data["name"])
+    return model
+
 def build_unet(input_shape, config_data):
     """
     Multi-class U-Net for colored mask segmentation.
     config_data must contain:
         - name: model name
         - num_classes: number of output classes
+    optional:
+        - remat: recompute conv block activations in the backward pass (less memory, more compute)
+        - width_multiplier: scales the default 64..1024 filters (rounded to a multiple of 8)
+        - depth: number of encoder levels (default 4), input size must be divisible by 2^depth
+        - filters: explicit filters per level, bridge last (overrides width_multiplier/depth)
+        - separable: depthwise-separable 3x3 convolutions in every conv block
+        - encoder: plain (default), mobilenetv2 or efficientnetb0 (efficientnet-lite maps to B0)
+        - encoder_weights: local weights file of the backbone (include_top=False)
+        - encoder_alpha: MobileNetV2 width (default 1.0)
     """
+    if config_data.get("encoder", "plain") != "plain":
+        return build_encoder_unet(input_shape, config_data)
+
     NUM_CLASSES = config_data.get("num_classes", 5)  # default 4 if not specified
+    remat = bool(config_data.get("remat", False))
+    separable = bool(config_data.get("separable", False))
+    filters = unet_filters(config_data)
+
+    depth = len(filters) - 1
+    if input_shape[0] % 2**depth or input_shape[1] % 2**depth:
+        raise ValueError(f"Input size {input_shape[:2]} is not divisible by 2^{depth}")
 
     inputs = Input(input_shape)
 
     # Encoder
-    s1, p1 = encoder_block(inputs, 64)
-    s2, p2 = encoder_block(p1, 128)
-    s3, p3 = encoder_block(p2, 256)
-    s4, p4 = encoder_block(p3, 512)
+    skips = []
+    x = inputs
+    for num_filters in filters[:-1]:
+        s, x = encoder_block(x, num_filters, remat, separable)
+        skips.append(s)
 
     # Bridge
-    b1 = conv_block(p4, 1024)
+    x = block(x, filters[-1], remat, separable)
 
     # Decoder
-    d1 = decoder_block(b1, s4, 512)
-    d2 = decoder_block(d1, s3, 256)
-    d3 = decoder_block(d2, s2, 128)
-    d4 = decoder_block(d3, s1, 64)
+    for num_filters, s in zip(reversed(filters[:-1]), reversed(skips)):
+        x = decoder_block(x, s, num_filters, remat, separable)
 
-    # Multi-class output
-    outputs = Conv2D(NUM_CLASSES, 1, padding="same", activation="softmax")(d4)
+    # Multi-class output (kept in float32 under mixed precision for a stable softmax and loss)
+    outputs = Conv2D(NUM_CLASSES, 1, padding="same", activation="softmax", dtype="float32")(x)
 
     model = Model(inputs, outputs, name=config_data["name"])
     return model
 
+# ---------------- COST SUMMARY ----------------
+def _conv_macs(layer, input_shape, output_shape):
+    """Multiply-accumulates of one convolution layer for a single image"""
+    if isinstance(layer, SeparableConv2D):
+        k = np.prod(layer.kernel_size)
+        c_in = input_shape[-1]
+        depthwise = np.prod(output_shape[1:3]) * k * c_in * layer.depth_multiplier
+        pointwise = np.prod(output_shape[1:3]) * c_in * layer.depth_multiplier * layer.filters
+        return depthwise + pointwise
+    if isinstance(layer, DepthwiseConv2D):
+        return np.prod(output_shape[1:3]) * np.prod(layer.kernel_size) * input_shape[-1] * layer.depth_multiplier
+    if isinstance(layer, Conv2DTranspose):
+        return np.prod(input_shape[1:3]) * np.prod(layer.kernel_size) * input_shape[-1] * layer.filters
+    if isinstance(layer, Conv2D):
+        return np.prod(output_shape[1:3]) * np.prod(layer.kernel_size) * input_shape[-1] * layer.filters
+    return 0
+
+def model_flops(model):
+    """FLOPs (2 x MACs) of the convolutions for one image; norms and activations are ignored"""
+    macs = 0
+    for layer in model.layers:
+        if isinstance(layer, Model):
+            macs += model_flops(layer) // 2  # nested encoder
+        elif isinstance(layer, ConvBlock):
+            input_shape = tuple(layer.input.shape)
+            output_shape = tuple(layer.output.shape)
+            macs += _conv_macs(layer.conv1, input_shape, output_shape)
+            macs += _conv_macs(layer.conv2, output_shape, output_shape)
+        elif isinstance(layer, (Conv2D, SeparableConv2D, DepthwiseConv2D, Conv2DTranspose)):
+            macs += _conv_macs(layer, tuple(layer.input.shape), tuple(layer.output.shape))
+    return 2 * int(macs)
+
+def model_latency_ms(model, runs=10, batch=1):
+    """Median inference latency on this host"""
+    x = tf.zeros((batch,) + tuple(model.input.shape[1:]))
+    predict = tf.function(lambda inputs: model(inputs, training=False))
+    predict(x).numpy()
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        predict(x).numpy()
+        times.append(time.perf_counter() - start)
+    return 1000 * float(np.median(times))
+
+def model_cost(model, latency_runs=10):
+    """Parameters, GFLOPs and latency of one 1-image forward pass"""
+    return {
+        "params": int(model.count_params()),
+        "gflops": model_flops(model) / 1e9,
+        "latency_ms": model_latency_ms(model, latency_runs) if latency_runs > 0 else None,
+        "device": "GPU" if tf.config.list_physical_devices("GPU") else "CPU",
+    }
+
+def print_model_cost(cost):
+    latency = f"{cost['latency_ms']:.1f} ms ({cost['device']}, batch 1)" if cost["latency_ms"] is not None else "n/a"
+    print(f"Params: {cost['params'] / 1e6:.2f} M | FLOPs: {cost['gflops']:.2f} G | Latency: {latency}")
+
 if __name__ == "__main__":
     input_shape = (256, 256, 3)
     config_data = {"name": "Unet_v1", "num_classes": 5}
     model = build_unet(input_shape, config_data)
     model.summary()
+    print_model_cost(model_cost(model))